@@ -13,6 +13,7 @@ from . import (
     client as cli,
     exc,
     handlers,
+    json_codec,
     models,
 )
 
@@ -55,6 +56,8 @@ _msg_handler: Optional[handlers.HandlerInterface] = None
 """插件消息处理器"""
 _msg_handler_wrapper: Optional['_HandlerWrapper'] = None
 """用于SDK处理一些消息，然后转发给插件消息处理器"""
+_handled_cmds: Optional[AbstractSet[int]] = frozenset({models.Command.BLC_INIT})
+"""需要处理的cmd，None表示所有cmd。包括SDK自己要处理的"""
 
 
 async def init():
@@ -113,13 +116,22 @@ def set_msg_handler(handler: Optional[handlers.HandlerInterface]):
 
     :param handler: 消息处理器
     """
-    global _msg_handler
+    global _msg_handler, _handled_cmds
     _msg_handler = handler
 
+    # 处理器没有处理的cmd在解析JSON之前就丢弃
+    handled_cmds = handler.get_handled_cmds() if handler is not None else frozenset()
+    if handled_cmds is not None:
+        handled_cmds = frozenset(handled_cmds) | {models.Command.BLC_INIT}
+    _handled_cmds = handled_cmds
+
 
 class _HandlerWrapper(handlers.HandlerInterface):
     """用于SDK处理一些消息，然后转发给插件消息处理器"""
 
+    def get_handled_cmds(self) -> Optional[AbstractSet[int]]:
+        return _handled_cmds
+
     def handle(self, client: cli.BlcPluginClient, command: dict):
         if not _init_future.done():
             if command['cmd'] == models.Command.BLC_INIT:
@@ -218,10 +230,10 @@ async def _blc_http_request(method, rel_url, **kwargs):
     try:
         async with _http_session.request(method, _blc_base_url + rel_url, **kwargs) as r:
             if r.ok:
-                return await r.json()
+                return json_codec.loads(await r.read())
 
             try:
-                data = await r.json()
+                data = await r.json(loads=json_codec.loads)
             except aiohttp.ContentTypeError:
                 data = None
             raise exc.ResponseError(r.status, r.reason, data)
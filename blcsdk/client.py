@@ -1,11 +1,13 @@
 # -*- coding: utf-8 -*-
 import asyncio
 import logging
+import re
 from typing import *
 
 import aiohttp
 
 from . import handlers
+from . import json_codec
 from . import models
 
 __all__ = (
@@ -14,6 +16,9 @@ __all__ = (
 
 logger = logging.getLogger('blcsdk')
 
+_CMD_PREFIX_PATTERN = re.compile(r'^\{\s*"cmd"\s*:\s*(\d+)')
+"""不解析整个JSON，只取出开头的cmd"""
+
 
 class BlcPluginClient:
     """
@@ -46,6 +51,9 @@ class BlcPluginClient:
         self._handler: Optional[handlers.HandlerInterface] = None
         """消息处理器"""
 
+        self.skipped_msg_count = 0
+        """处理器不需要，没有解析就丢弃的消息数"""
+
         # 在运行时初始化的字段
         self._websocket: Optional[aiohttp.ClientWebSocketResponse] = None
         """WebSocket连接"""
@@ -121,7 +129,7 @@ class BlcPluginClient:
             raise ConnectionResetError('websocket is closed')
 
         body = {'cmd': cmd, 'data': data}
-        await self._websocket.send_json(body)
+        await self._websocket.send_json(body, dumps=json_codec.dumps)
 
     async def _network_coroutine_wrapper(self):
         """负责处理网络协程的异常，网络协程具体逻辑在_network_coroutine里"""
@@ -203,8 +211,17 @@ class BlcPluginClient:
             logger.warning('Unknown websocket message type=%s, data=%s', message.type, message.data)
             return
 
+        # 处理器不需要的cmd直接丢弃。cmd不在开头时还是要解析整个JSON
+        if self._handler is not None:
+            handled_cmds = self._handler.get_handled_cmds()
+            if handled_cmds is not None:
+                match = _CMD_PREFIX_PATTERN.match(message.data)
+                if match is not None and int(match[1]) not in handled_cmds:
+                    self.skipped_msg_count += 1
+                    return
+
         try:
-            body = message.json()
+            body = message.json(loads=json_codec.loads)
             self._handle_command(body)
         except Exception:
             logger.error('body=%s', message.data)
@@ -16,6 +16,14 @@ class HandlerInterface:
     def handle(self, client: cli.BlcPluginClient, command: dict):
         raise NotImplementedError
 
+    def get_handled_cmds(self) -> Optional[AbstractSet[int]]:
+        """
+        返回需要处理的cmd集合，None表示处理所有cmd
+
+        SDK在set_msg_handler时调用一次并缓存结果，收到其他cmd的消息时连JSON都不解析，直接丢弃
+        """
+        return None
+
     def on_client_stopped(self, client: cli.BlcPluginClient, exception: Optional[Exception]):
         """
         当客户端停止时调用
@@ -30,9 +38,14 @@ def _make_msg_callback(method_name, message_cls):
         msg = message_cls.from_command(command['data'])
         extra = models.ExtraData.from_dict(command.get('extra', {}))
         return method(client, msg, extra)
+    callback.method_name = method_name
     return callback
 
 
+_handler_cls_callback_dict_cache: Dict[type, Dict[int, Callable]] = {}
+"""处理器类 -> 这个类真正重写了的cmd -> 处理回调"""
+
+
 class BaseHandler(HandlerInterface):
     """一个简单的消息处理器实现，带消息分发和消息类型转换。继承并重写_on_xxx方法即可实现自己的处理器"""
 
@@ -60,10 +73,37 @@ class BaseHandler(HandlerInterface):
 
     def handle(self, client: cli.BlcPluginClient, command: dict):
         cmd = command['cmd']
-        callback = self._CMD_CALLBACK_DICT.get(cmd, None)
+        # 没有重写_on_xxx的cmd不用构造消息对象
+        callback = self._get_callback_dict().get(cmd, None)
         if callback is not None:
             callback(self, client, command)
 
+    def get_handled_cmds(self) -> Optional[AbstractSet[int]]:
+        if type(self).handle is not BaseHandler.handle:
+            # 重写了handle，不知道要处理哪些cmd
+            return None
+        return frozenset(self._get_callback_dict())
+
+    def _get_callback_dict(self) -> Dict[int, Callable]:
+        """
+        取这个类真正重写了_on_xxx方法的cmd -> 处理回调，按类缓存
+
+        只看类上定义的方法，在实例上动态设置的_on_xxx不会被发现
+        """
+        cls = type(self)
+        callback_dict = _handler_cls_callback_dict_cache.get(cls, None)
+        if callback_dict is None:
+            callback_dict = {}
+            for cmd, callback in cls._CMD_CALLBACK_DICT.items():
+                if callback is None:
+                    continue
+                method_name = getattr(callback, 'method_name', None)
+                # 自定义的回调不知道调用了什么，总是保留
+                if method_name is None or getattr(cls, method_name) is not getattr(BaseHandler, method_name, None):
+                    callback_dict[cmd] = callback
+            _handler_cls_callback_dict_cache[cls] = callback_dict
+        return callback_dict
+
     def _on_add_room(self, client: cli.BlcPluginClient, message: models.AddRoomMsg, extra: models.ExtraData):
         """添加房间"""
 
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+JSON编解码
+
+安装了orjson或msgspec时使用更快的实现，否则使用标准库。loads可以直接传bytes，不需要先解码成str
+"""
+import json
+from typing import *
+
+__all__ = (
+    'BACKEND',
+    'loads',
+    'dumps',
+)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+BACKEND: str
+"""当前使用的实现"""
+loads: Callable[[Union[bytes, bytearray, str]], Any]
+"""解析JSON，参数可以是bytes或str"""
+
+if orjson is not None:
+    BACKEND = 'orjson'
+    loads = orjson.loads
+
+    def dumps(obj) -> str:
+        """序列化为JSON字符串"""
+        return orjson.dumps(obj).decode('utf-8')
+
+elif msgspec is not None:
+    BACKEND = 'msgspec'
+    _encoder = msgspec.json.Encoder()
+    loads = msgspec.json.Decoder().decode
+
+    def dumps(obj) -> str:
+        """序列化为JSON字符串"""
+        return _encoder.encode(obj).decode('utf-8')
+
+else:
+    BACKEND = 'json'
+    loads = json.loads
+
+    def dumps(obj) -> str:
+        """序列化为JSON字符串"""
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
@@ -1,13 +1,19 @@
 # -*- coding: utf-8 -*-
 import os
 
-# ===不要改这三个PATH===
+# ===不要改这些PATH===
 BASE_PATH = os.path.dirname(os.path.realpath(__file__))
 LOG_PATH = os.path.join(BASE_PATH, 'log')
+DATA_PATH = os.path.join(BASE_PATH, 'data')
 CONFIG_PATH = os.path.join(BASE_PATH, 'config.py')
 
 # ===用户配置===
 USER_NAME = "set you osu name" # 用户名
 PASSWORD = "get your irc password" # irc密码
 API_SERVER = "osu_html" # 获取谱面方式，默认从官网获取
-SEND_SELF:bool = True # 是否转发给自己，lazer请设置为false让消息转发给BanchoBot
\ No newline at end of file
+SEND_SELF:bool = True # 是否转发给自己，lazer请设置为false让消息转发给BanchoBot
+RACE_HEDGE_DELAY:float = 1.0 # API_SERVER为race时，等待多少秒没有结果就同时请求下一个API，设为0则同时请求所有API
+USER_REQUEST_BURST:int = 3 # 每个观众最多连续点几首歌，设为0则不限制
+USER_REQUEST_INTERVAL:float = 30.0 # 连续点完之后每隔多少秒可以再点一首
+MAP_DEDUPE_WINDOW:float = 300.0 # 同一个直播间多少秒内重复点同一张图只处理第一次，设为0则不去重。醒目留言不受这些限制
+LOG_JSON:bool = False # 文件日志是否使用JSON格式（每行一个JSON），方便用工具分析
\ No newline at end of file
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+点歌记录
+
+所有点歌请求（包括被限流忽略的）都记录在SQLite数据库里，按直播间和时间、按时间建了索引，可以快速查询某个（或所有）直播间某段时间的点歌和
+每张图被点的次数。直接运行这个文件可以在命令行查询：
+
+python history.py recent --room 123 --days 7
+python history.py top-maps --room 123 --since 2026-10-01
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import datetime
+import logging
+import os
+import sqlite3
+import sys
+import time
+from typing import *
+
+import config
+
+__all__ = (
+    'RequestHistory',
+    'query_requests',
+    'count_maps',
+)
+
+logger = logging.getLogger('osu-requests-bot.' + __name__)
+
+DB_PATH = os.path.join(config.DATA_PATH, 'request_history.db')
+
+_COLUMNS = ('ts', 'room_id', 'uid', 'author', 'map_id', 'sid', 'server', 'latency', 'outcome')
+
+
+class RequestHistory:
+    """
+    点歌记录的存储，只追加
+
+    和InfoStore一样，数据库在第一次使用时才打开，所有读写都在一个专用线程里执行，不会阻塞事件循环。出错时只记日志
+
+    :param path: 数据库文件路径
+    """
+
+    def __init__(self, path: str = DB_PATH):
+        self._path = path
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='request-history')
+        self._conn: Optional[sqlite3.Connection] = None
+        """只在专用线程里访问"""
+        self._closed = False
+
+    def record(
+        self,
+        room_id: int,
+        uid: str,
+        author: str,
+        map_id: str,
+        outcome: str,
+        sid: Optional[int] = None,
+        server: Optional[str] = None,
+        latency: Optional[float] = None,
+    ):
+        """
+        记录一个点歌请求，在后台线程写入，不等待写入完成
+
+        :param room_id: 直播间ID
+        :param uid: 观众的uid
+        :param author: 观众的名字
+        :param map_id: 点歌的ID，如b123
+        :param outcome: 处理结果，见listener
+        :param sid: 获取到的BeatMapSetID
+        :param server: 获取谱面信息用的API
+        :param latency: 从开始处理到发送出去的秒数
+        """
+        if self._closed:
+            return
+        row = (int(time.time()), room_id, uid, author, map_id, sid, server, latency, outcome)
+        self._executor.submit(self._insert_sync, row)
+
+    async def query(self, **kwargs) -> List[dict]:
+        """查询点歌记录，参数见query_requests"""
+        return await self._run_query(query_requests, **kwargs)
+
+    async def count_maps(self, **kwargs) -> List[Tuple[str, int]]:
+        """统计每张图被点的次数，参数见count_maps"""
+        return await self._run_query(count_maps, **kwargs)
+
+    async def close(self):
+        """等待未完成的写入，然后关闭数据库"""
+        if self._closed:
+            return
+        self._closed = True
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._close_sync)
+        self._executor.shutdown(wait=False)
+
+    async def _run_query(self, func, **kwargs):
+        if self._closed:
+            return []
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, lambda: func(self._get_conn(), **kwargs)
+        )
+
+    def _get_conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            conn = sqlite3.connect(self._path)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            _create_tables(conn)
+            self._conn = conn
+        return self._conn
+
+    def _insert_sync(self, row: tuple):
+        try:
+            conn = self._get_conn()
+            conn.execute(f'INSERT INTO request ({", ".join(_COLUMNS)}) VALUES ({", ".join("?" * len(_COLUMNS))})', row)
+            conn.commit()
+        except sqlite3.Error:
+            logger.exception('RequestHistory insert failed, row=%s', row)
+
+    def _close_sync(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def _create_tables(conn: sqlite3.Connection):
+    conn.execute(
+        'CREATE TABLE IF NOT EXISTS request ('
+        'id INTEGER PRIMARY KEY, '
+        'ts INTEGER NOT NULL, '
+        'room_id INTEGER NOT NULL, '
+        'uid TEXT NOT NULL, '
+        'author TEXT NOT NULL, '
+        'map_id TEXT NOT NULL, '
+        'sid INTEGER, '
+        'server TEXT, '
+        'latency REAL, '
+        'outcome TEXT NOT NULL'
+        ')'
+    )
+    # 按直播间和时间范围查询、不指定直播间按时间范围查询、按图统计都走索引
+    conn.execute('CREATE INDEX IF NOT EXISTS request_room_ts ON request (room_id, ts)')
+    conn.execute('CREATE INDEX IF NOT EXISTS request_ts ON request (ts)')
+    conn.execute('CREATE INDEX IF NOT EXISTS request_map_id ON request (map_id)')
+    conn.commit()
+
+
+def _make_where(
+    room_id: Optional[int] = None,
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+    map_id: Optional[str] = None,
+) -> Tuple[str, list]:
+    conditions = []
+    params = []
+    if room_id is not None:
+        conditions.append('room_id = ?')
+        params.append(room_id)
+    if since is not None:
+        conditions.append('ts >= ?')
+        params.append(int(since))
+    if until is not None:
+        conditions.append('ts < ?')
+        params.append(int(until))
+    if map_id is not None:
+        conditions.append('map_id = ?')
+        params.append(map_id)
+    where = ('WHERE ' + ' AND '.join(conditions)) if conditions else ''
+    return where, params
+
+
+def query_requests(
+    conn: sqlite3.Connection,
+    room_id: Optional[int] = None,
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+    map_id: Optional[str] = None,
+    limit: int = 100,
+) -> List[dict]:
+    """
+    查询点歌记录，按时间从新到旧
+
+    :param conn: 数据库连接
+    :param room_id: 直播间ID，None表示所有直播间
+    :param since: 开始时间戳（包括）
+    :param until: 结束时间戳（不包括）
+    :param map_id: 只查这张图，如b123
+    :param limit: 最多返回多少条
+    """
+    where, params = _make_where(room_id, since, until, map_id)
+    cursor = conn.execute(
+        f'SELECT {", ".join(_COLUMNS)} FROM request {where} ORDER BY ts DESC, id DESC LIMIT ?', (*params, limit)
+    )
+    return [dict(zip(_COLUMNS, row)) for row in cursor]
+
+
+def count_maps(
+    conn: sqlite3.Connection,
+    room_id: Optional[int] = None,
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+    limit: int = 20,
+) -> List[Tuple[str, int]]:
+    """
+    统计每张图被点的次数，按次数从多到少，返回[(map_id, 次数)]
+
+    参数同query_requests
+    """
+    where, params = _make_where(room_id, since, until)
+    # +map_id让SQLite不用request_map_id索引来分组，否则不指定直播间时会为了省掉排序扫描整个索引，而不是按时间范围查
+    cursor = conn.execute(
+        f'SELECT map_id, COUNT(*) AS count FROM request {where} GROUP BY +map_id ORDER BY count DESC, map_id LIMIT ?',
+        (*params, limit)
+    )
+    return cursor.fetchall()
+
+
+def _parse_time(text: str) -> float:
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(text, fmt).timestamp()
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError(f'invalid time: {text!r}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='查询点歌记录')
+    parser.add_argument('--db', default=DB_PATH, help='数据库路径')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for name, help_text in (('recent', '查询点歌记录'), ('top-maps', '统计每张图被点的次数')):
+        sub = subparsers.add_parser(name, help=help_text)
+        sub.add_argument('--room', type=int, help='直播间ID')
+        sub.add_argument('--since', type=_parse_time, help='开始时间，如2026-10-01或"2026-10-01 20:00"')
+        sub.add_argument('--until', type=_parse_time, help='结束时间')
+        sub.add_argument('--days', type=float, help='最近多少天，和--since同时使用时以--since为准')
+        sub.add_argument('--limit', type=int, default=100 if name == 'recent' else 20, help='最多显示多少条')
+        if name == 'recent':
+            sub.add_argument('--map', help='只查这张图，如b123')
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.db):
+        print(f'{args.db} 不存在', file=sys.stderr)
+        return 1
+    since = args.since
+    if since is None and args.days is not None:
+        since = time.time() - args.days * 24 * 60 * 60
+
+    conn = sqlite3.connect(f'file:{args.db}?mode=ro', uri=True)
+    try:
+        if args.command == 'recent':
+            for row in query_requests(conn, args.room, since, args.until, args.map, args.limit):
+                time_str = datetime.datetime.fromtimestamp(row['ts']).strftime('%Y-%m-%d %H:%M:%S')
+                latency = f'{row["latency"]:.2f}s' if row['latency'] is not None else '-'
+                print(
+                    f'{time_str}\t{row["room_id"]}\t{row["author"]}({row["uid"]})\t{row["map_id"]}\t'
+                    f'sid={row["sid"] or "-"}\t{row["server"] or "-"}\t{latency}\t{row["outcome"]}'
+                )
+        else:
+            for map_id, count in count_maps(conn, args.room, since, args.until, args.limit):
+                print(f'{map_id}\t{count}')
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,52 +1,253 @@
 import aiohttp, asyncio
-import json, re
-from typing import Any
+from typing import Any, NamedTuple, Optional
 from collections.abc import Callable
+import functools
 import logging
+import os
+import time
+
+import config
+from blcsdk import json_codec
+from info_cache import InfoCache, InfoStore, MISS
+from server_stats import CircuitBreaker, ServerStatsTable
 
 logger = logging.getLogger('osu-irc-client')
 
-RE_BEATMAPSET = r'<script id="json-beatmapset" type="application/json">\n        (.*?)\n    </script>'
+BEATMAPSET_SCRIPT_START = b'<script id="json-beatmapset" type="application/json">'
+SCRIPT_END = b'</script>'
+READ_CHUNK_SIZE = 16 * 1024
 
 GET_INFO_COMMON: dict[str, Callable[[str, int], Any]] = {}
 TIMEOUT = 5
 
+# 连接池设置
+CONN_LIMIT = 30
+CONN_LIMIT_PER_HOST = 6
+DNS_CACHE_TTL = 300
+KEEPALIVE_TIMEOUT = 60
+
+# 谱面信息缓存设置
+CACHE_SIZE = 2048
+CACHE_TTL = 6 * 60 * 60
+NEGATIVE_CACHE_TTL = 60
+
+info_cache = InfoCache(CACHE_SIZE, CACHE_TTL, NEGATIVE_CACHE_TTL)
+"""谱面信息的内存缓存，key是(mapid_type, mapid_num)"""
+info_store = InfoStore(os.path.join(config.DATA_PATH, 'beatmap_info.db'))
+"""谱面信息的本地存储，内存缓存没有命中时再查这里"""
+
+# API统计与后台探测设置
+STATS_ALPHA = 0.2
+PROBE_INTERVAL = 5 * 60
+PROBE_MAPID = ("b", 75)
+
+server_stats = ServerStatsTable(os.path.join(config.DATA_PATH, 'server_stats.json'), STATS_ALPHA)
+"""各API的延迟和成功率统计，auto和race模式按期望耗时决定尝试顺序"""
+# 熔断器设置
+BREAKER_FAILURE_THRESHOLD = 3
+BREAKER_COOLDOWN = 30
+
+_breakers: dict[str, CircuitBreaker] = {}
+"""API名称 -> 熔断器"""
+_probe_task: Optional[asyncio.Task] = None
+"""后台探测API状态的任务"""
+
+_inflight_lookups: dict[tuple[str, int], asyncio.Task] = {}
+"""正在获取的谱面信息，同一个谱面同时只请求一次，key是(mapid_type, mapid_num)"""
+
+_http_session: Optional[aiohttp.ClientSession] = None
+"""所有获取谱面信息的请求共用的HTTP客户端，保持长连接避免每次都重新DNS解析、TCP连接、TLS握手"""
+
+class _Failed:
+    def __bool__(self):
+        return False
+
+    def __repr__(self):
+        return "FAILED"
+
+FAILED = _Failed()
+"""
+API出错（超时、连接失败等）或者被熔断跳过，没有得到结果  
+和None（API回答了没有这个谱面）区分开，只有None会写进负缓存。和None一样是假值，`if info:`的判断不用改
+"""
+
+class MapId(NamedTuple):
+    """
+    点歌请求里的谱面ID  
+    从谱面链接里解析出来时可能同时知道sid，这时候不需要再通过API查询bid属于哪个谱面集
+    """
+    mapid_type: str
+    """b或s"""
+    mapid_num: int
+    sid: int|None = None
+    """BeatMapSetID，不知道时为None"""
+    mode: str|None = None
+    """链接里的游戏模式（osu、taiko、fruits、mania），不知道时为None"""
+
+    def __str__(self):
+        return f"{self.mapid_type}{self.mapid_num}"
+
+async def init():
+    """
+    创建共用的HTTP客户端，加载API统计信息  
+    获取谱面信息之前必须先调用这个
+    """
+    global _http_session, _probe_task
+    if _http_session is not None:
+        return
+    connector = aiohttp.TCPConnector(
+        limit=CONN_LIMIT,
+        limit_per_host=CONN_LIMIT_PER_HOST,
+        ttl_dns_cache=DNS_CACHE_TTL,
+        keepalive_timeout=KEEPALIVE_TIMEOUT,
+    )
+    _http_session = aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=TIMEOUT),
+    )
+
+    server_stats.load()
+    if config.API_SERVER in ("auto", "race"):
+        _probe_task = asyncio.create_task(_probe_servers())
+
+async def shut_down():
+    """关闭共用的HTTP客户端，保存API统计信息"""
+    global _http_session, _probe_task
+    if _probe_task is not None:
+        _probe_task.cancel()
+        await asyncio.wait([_probe_task])
+        _probe_task = None
+    logger.info(f"谱面信息缓存统计：{info_cache.get_stats()}，本地存储统计：{info_store.get_stats()}")
+    logger.info(f"API统计：{get_server_stats()}")
+    server_stats.save()
+    await info_store.close()
+    if _http_session is not None:
+        await _http_session.close()
+        _http_session = None
+
+def get_session() -> aiohttp.ClientSession:
+    """
+    取共用的HTTP客户端  
+    第三方API需要直接发送请求时也请使用这个
+    """
+    assert _http_session is not None, 'Please call info_api.init() first'
+    return _http_session
+
 async def get_url_json(url:str) -> dict:
     """
     使用aiohttp获取json信息  
     如果没有信息就返回空字典  
-    由于sayo镜像站使用的json返回有问题，因此需要解析为text再解析回json
+    由于sayo镜像站使用的json返回有问题，因此不使用response.json()，直接读取内容再解析json
     """
-    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=TIMEOUT)) as session:
-        async with session.get(url=url) as response:
-            if response.status == 200:
-                data_text = await response.text()
-                return json.loads(data_text)
-            return {}
+    async with get_session().get(url=url) as response:
+        if response.status == 200:
+            return json_codec.loads(await response.read())
+        return {}
 
-async def get_response(source_url:str) -> tuple[str, str]:
+async def get_response(source_url:str) -> tuple[str, dict|None]:
     '''
-    使用aiohttp获取重定向一次后的链接与网页信息  
+    使用aiohttp获取重定向一次后的链接与谱面页面里的谱面信息  
     如果没有重定向则直接返回response的链接  
     只适用于OSU这种只重定向一次的情况，其他情况需要考虑更改代码
     '''
-    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=TIMEOUT)) as session:
-        async with session.get(source_url, allow_redirects=False) as response:
+    session = get_session()
+    async with session.get(source_url, allow_redirects=False) as response:
 
-            if response.status == 302 and "Location" in response.headers:
-                target_url = response.headers["Location"]
-                async with session.get(target_url) as response:
-                    html_text = await response.text()
+        if response.status == 302 and "Location" in response.headers:
+            target_url = response.headers["Location"]
+            async with session.get(target_url) as response:
+                json_data = await read_beatmapset_json(response) if response.status == 200 else None
 
-            elif response.status == 200:
-                target_url = str(response.url)
-                html_text = await response.text()
+        elif response.status == 200:
+            target_url = str(response.url)
+            json_data = await read_beatmapset_json(response)
 
-            elif response.status == 404:
-                target_url = ""
-                html_text  = ""
+        else:
+            target_url = ""
+            json_data  = None
+
+    return (target_url, json_data)
 
-    return (target_url, html_text)
+async def read_beatmapset_json(response:aiohttp.ClientResponse) -> dict|None:
+    '''
+    分块读取谱面页面，找到json-beatmapset的script块后只解析这段JSON  
+    解析完直接关闭连接，不再读取页面剩下的部分  
+    没有找到则返回None
+    '''
+    buffer = bytearray()
+    found_start = False
+    async for chunk in response.content.iter_chunked(READ_CHUNK_SIZE):
+        # 标记可能跨两个分块，从上个分块末尾开始找
+        marker = SCRIPT_END if found_start else BEATMAPSET_SCRIPT_START
+        search_from = max(0, len(buffer) - len(marker) + 1)
+        buffer += chunk
+
+        if not found_start:
+            index = buffer.find(BEATMAPSET_SCRIPT_START, search_from)
+            if index < 0:
+                # 只保留末尾可能是开始标记前半段的部分
+                del buffer[:max(0, len(buffer) - len(BEATMAPSET_SCRIPT_START) + 1)]
+                continue
+            del buffer[:index + len(BEATMAPSET_SCRIPT_START)]
+            found_start = True
+            search_from = 0
+
+        index = buffer.find(SCRIPT_END, search_from)
+        if index >= 0:
+            response.close()
+            return json_codec.loads(bytes(buffer[:index]))
+    return None
+
+def get_server_stats() -> dict[str, dict]:
+    """
+    取各API的统计信息，包括平均延迟、成功率和期望耗时
+    """
+    return {server_name: {**server_stats.get(server_name).to_dict(),
+                          "expected_time": server_stats.get(server_name).expected_time,
+                          "breaker": _get_breaker(server_name).get_stats()}
+            for server_name in GET_INFO_COMMON}
+
+def _get_breaker(server_name:str) -> CircuitBreaker:
+    breaker = _breakers.get(server_name, None)
+    if breaker is None:
+        breaker = _breakers[server_name] = CircuitBreaker(server_name, BREAKER_FAILURE_THRESHOLD, BREAKER_COOLDOWN)
+    return breaker
+
+async def _probe_servers():
+    """
+    定时用一个已知的谱面请求最近没有用过的API，保持统计信息不过时
+    """
+    while True:
+        await asyncio.sleep(PROBE_INTERVAL)
+        for server_name in server_stats.get_idle_servers(GET_INFO_COMMON, PROBE_INTERVAL):
+            logger.debug(f"正在探测{server_name}")
+            await _call_server(server_name, *PROBE_MAPID)
+        await asyncio.to_thread(server_stats.save)
+
+async def _call_server(server_name:str, mapid_type:str, mapid_num:int) -> dict|None|_Failed:
+    """
+    调用注册的API并记录延迟和是否成功  
+    API抛出异常（超时、连接失败等）时返回FAILED，连续失败的API会被熔断，熔断期间直接返回FAILED
+    """
+    breaker = _get_breaker(server_name)
+    if not breaker.allow_request():
+        logger.info(f"{server_name}已熔断，跳过")
+        return FAILED
+
+    start_time = time.monotonic()
+    try:
+        info = await GET_INFO_COMMON[server_name](mapid_type, mapid_num)
+    except asyncio.CancelledError:
+        breaker.release()
+        raise
+    except Exception as e:
+        breaker.record_failure()
+        server_stats.record(server_name, time.monotonic() - start_time, False)
+        logger.warning(f"从{server_name}获取谱面信息失败：{e!r}")
+        return FAILED
+    breaker.record_success()
+    server_stats.record(server_name, time.monotonic() - start_time, bool(info))
+    return info
 
 def register_info_server(server_name:str):
     '''
@@ -57,52 +258,161 @@ def register_info_server(server_name:str):
         return func
     return decorator
 
-async def get_info(mapid_type:str, mapid_num:int, server_name:str = "auto") -> dict|None:
+async def get_info(mapid_type:str, mapid_num:int, server_name:str = "auto",
+                   sid:int|None = None, mode:str|None = None) -> dict|None:
     """
     获取谱面信息，如果获取失败将会返回None  
+    bid已经知道sid和mode时（从谱面链接解析出来的），先获取谱面集的信息再拼出谱面信息，谱面集已经缓存时不需要请求网络。
+    链接里的sid和mode是观众发的，没有验证过，拼出来的信息只返回给这个请求，不写进bid的缓存和本地存储  
     返回的字典：  
     {"server": 所使用的API
      "artist": 艺术家信息,  
      "title" : 歌曲标题，
      "sid"   : BeatMapSetID  
      "url"   : 谱面链接"}  
+    同一个谱面同时有多个请求时只会获取一次，结果（包括异常）由所有请求共享
+    """
+    cache_key = (mapid_type, mapid_num)
+    info = info_cache.get(cache_key)
+    if info is not MISS:
+        logger.info(f"谱面信息缓存命中：{mapid_type}{mapid_num}")
+        return info
+
+    if mapid_type == "b" and sid is not None and mode is not None:
+        set_info = await get_info("s", sid, server_name)
+        if set_info:
+            return {**set_info, "url": f"https://osu.ppy.sh/beatmapsets/{sid}#{mode}/{mapid_num}"}
+
+    task = _inflight_lookups.get(cache_key, None)
+    if task is None:
+        task = asyncio.create_task(_lookup_info(mapid_type, mapid_num, server_name))
+        _inflight_lookups[cache_key] = task
+        task.add_done_callback(functools.partial(_on_lookup_done, cache_key))
+    else:
+        logger.info(f"谱面信息正在获取中，等待结果：{mapid_type}{mapid_num}")
+    # 用shield防止其中一个请求被取消时把共享的任务也取消了
+    return await asyncio.shield(task)
+
+def _on_lookup_done(cache_key:tuple[str, int], task:asyncio.Task):
+    if _inflight_lookups.get(cache_key, None) is task:
+        del _inflight_lookups[cache_key]
+    # 等待的请求都被取消时没人取异常，这里取一下避免asyncio报警告
+    if not task.cancelled():
+        task.exception()
+
+async def _lookup_info(mapid_type:str, mapid_num:int, server_name:str) -> dict|None:
+    """
+    缓存没有命中时查本地存储和API，并写入缓存
+    """
+    cache_key = (mapid_type, mapid_num)
+    info = await info_store.get(cache_key)
+    if info:
+        logger.info(f"谱面信息本地存储命中：{mapid_type}{mapid_num}")
+        info_cache.put(cache_key, info)
+        return info
+
+    info = await _get_info_from_server(mapid_type, mapid_num, server_name)
+    if info is FAILED:
+        # 没有API回答，可能只是暂时的，不写负缓存，下次再试
+        return None
+    if info:
+        info_store.put(cache_key, info)
+    info_cache.put(cache_key, info if info else None)
+    return info
+
+async def _get_info_from_server(mapid_type:str, mapid_num:int, server_name:str) -> dict|None|_Failed:
+    """
+    从注册的API获取谱面信息，不经过缓存  
+    有API回答了没有这个谱面时返回None，所有用到的API都出错或者被熔断时返回FAILED
     """
     if server_name == "auto":
-        for server_name in GET_INFO_COMMON:
+        result = FAILED
+        for server_name in server_stats.sort(GET_INFO_COMMON):
             logger.info(f"正在尝试从{server_name}获取谱面信息")
-            info = await GET_INFO_COMMON[server_name](mapid_type, mapid_num)
+            info = await _call_server(server_name, mapid_type, mapid_num)
             if info:
                 return info
+            if info is None:
+                result = None
+        return result
+    elif server_name == "race":
+        return await _get_info_race(mapid_type, mapid_num)
     else:
         logger.info(f"正在获取谱面信息")
-        info = await GET_INFO_COMMON[server_name](mapid_type, mapid_num)
+        info = await _call_server(server_name, mapid_type, mapid_num)
         if info or server_name == "osu_html":
             return info
-        else:
-            return await GET_INFO_COMMON["osu_html"](mapid_type, mapid_num)
+        fallback_info = await _call_server("osu_html", mapid_type, mapid_num)
+        if fallback_info is FAILED and info is None:
+            return None
+        return fallback_info
+
+async def _get_info_race(mapid_type:str, mapid_num:int) -> dict|None|_Failed:
+    """
+    竞速模式：先请求期望耗时最短的API，超过config.RACE_HEDGE_DELAY秒没有结果或者失败了就再请求下一个  
+    RACE_HEDGE_DELAY <= 0 时同时请求所有API  
+    使用最先返回的有效结果，其他还没完成的请求会被取消。都没有结果时和_get_info_from_server一样区分None和FAILED
+    """
+    server_names = server_stats.sort(GET_INFO_COMMON)
+    result = FAILED
+    hedge_delay = config.RACE_HEDGE_DELAY
+    pending: set[asyncio.Task] = set()
+    next_index = 0
+    try:
+        while True:
+            if next_index < len(server_names):
+                server_name = server_names[next_index]
+                next_index += 1
+                logger.info(f"正在尝试从{server_name}获取谱面信息")
+                pending.add(asyncio.create_task(_call_server(server_name, mapid_type, mapid_num), name=server_name))
+                if hedge_delay <= 0:
+                    continue
+            if not pending:
+                return result
+
+            # 还有没请求的API时，最多等hedge_delay秒就去请求下一个
+            timeout = hedge_delay if next_index < len(server_names) else None
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                info = task.result()
+                if info:
+                    return info
+                if info is None:
+                    result = None
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
 
 # 从官网网页爬取谱面数据
 @register_info_server("osu_html")
 async def get_info_osu_html(mapid_type:str, mapid_num:int) -> dict[str,str]|None:
     '''
     解析谱面页面获取谱面信息  
+    sid直接请求谱面集页面，不用经过一次重定向  
     '''
-    map_url, html_text = await get_response(f"https://osu.ppy.sh/{mapid_type}/{mapid_num}")
+    map_url, json_data = await get_response(_get_osu_page_url(mapid_type, mapid_num))
     # 更换mapid类型尝试二次搜索
     if not map_url:
         mapid_type = "s" if mapid_type == "b" else "b"
-        map_url, html_text = await get_response(f"https://osu.ppy.sh/{mapid_type}/{mapid_num}")
+        map_url, json_data = await get_response(_get_osu_page_url(mapid_type, mapid_num))
     
     if map_url:
         # 从网页获取谱面信息
-        match = re.search(RE_BEATMAPSET, html_text, re.IGNORECASE)
-        if match:
-            json_data = json.loads(match.group(1))
+        if json_data:
             return  {"server": "osu_html",
                      "artist": json_data["artist"],
                      "title" : json_data["title"],
                      "sid"   : json_data["id"],
                      "url"   : map_url
                     }
+
+def _get_osu_page_url(mapid_type:str, mapid_num:int) -> str:
+    # 谱面集直接用最终的链接，谱面只有bid时不知道sid，只能靠重定向
+    if mapid_type == "s":
+        return f"https://osu.ppy.sh/beatmapsets/{mapid_num}"
+    return f"https://osu.ppy.sh/{mapid_type}/{mapid_num}"
+
 # 导入第三方API
 import server
\ No newline at end of file
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import os
+import sqlite3
+import time
+from typing import *
+
+from blcsdk import json_codec
+
+__all__ = (
+    'MISS',
+    'InfoCache',
+    'InfoStore',
+)
+
+logger = logging.getLogger('osu-requests-bot.' + __name__)
+
+MISS = object()
+"""InfoCache.get没有命中时的返回值，用来和负缓存的None区分"""
+
+
+class InfoCache:
+    """
+    谱面信息的内存缓存，LRU + TTL
+
+    获取失败的谱面会以None缓存一小段时间（负缓存），避免刷错误ID的时候每条弹幕都去请求API
+
+    :param max_size: 最多缓存多少条，超过后淘汰最久没用的
+    :param ttl: 正常结果的缓存时间（秒）
+    :param negative_ttl: 负缓存的缓存时间（秒）
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 6 * 60 * 60, negative_ttl: float = 60):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+
+        self._data: collections.OrderedDict[Hashable, Tuple[float, Optional[dict]]] = collections.OrderedDict()
+        """key -> (过期时间, 谱面信息)"""
+
+        self.hits = 0
+        """命中次数，包括负缓存"""
+        self.negative_hits = 0
+        """负缓存命中次数"""
+        self.misses = 0
+        """没有命中的次数，包括已过期"""
+        self.evictions = 0
+        """因为容量满了被淘汰的条数"""
+        self.expirations = 0
+        """因为过期被删除的条数"""
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key: Hashable):
+        """
+        取缓存
+
+        :return: 谱面信息；负缓存返回None；没有命中返回MISS
+        """
+        entry = self._data.get(key, None)
+        if entry is None:
+            self.misses += 1
+            return MISS
+
+        expire_time, info = entry
+        if expire_time <= time.monotonic():
+            del self._data[key]
+            self.expirations += 1
+            self.misses += 1
+            return MISS
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        if info is None:
+            self.negative_hits += 1
+        return info
+
+    def put(self, key: Hashable, info: Optional[dict]):
+        """
+        写缓存
+
+        :param key: 缓存key
+        :param info: 谱面信息，None表示获取失败，会按负缓存的时间保存
+        """
+        ttl = self._ttl if info is not None else self._negative_ttl
+        if ttl <= 0:
+            return
+        self._data[key] = (time.monotonic() + ttl, info)
+        self._data.move_to_end(key)
+        while len(self._data) > self._max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self._data.clear()
+
+    def get_stats(self) -> dict:
+        """取统计信息，用来调整缓存大小"""
+        return {
+            'size': len(self._data),
+            'max_size': self._max_size,
+            'hits': self.hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+
+class InfoStore:
+    """
+    谱面信息的本地持久化存储，重启后不用重新请求API
+
+    使用SQLite的WAL模式，按主键查询，不会在启动时把整个文件读进内存。数据库在第一次使用时才打开，所有读写都在一个专用线程里执行，
+    不会阻塞事件循环。这只是个加速用的存储，出错时只记日志，当作没有命中
+
+    :param path: 数据库文件路径
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='info-store')
+        self._conn: Optional[sqlite3.Connection] = None
+        """只在专用线程里访问"""
+        self._closed = False
+
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key: Tuple[str, int]) -> Optional[dict]:
+        """
+        取谱面信息
+
+        :param key: (mapid_type, mapid_num)
+        :return: 谱面信息，没有则返回None
+        """
+        if self._closed:
+            return None
+        info = await asyncio.get_running_loop().run_in_executor(self._executor, self._get_sync, key)
+        if info is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return info
+
+    def put(self, key: Tuple[str, int], info: dict):
+        """
+        写入谱面信息，在后台线程执行，不等待写入完成
+
+        :param key: (mapid_type, mapid_num)
+        :param info: 谱面信息
+        """
+        if self._closed:
+            return
+        self._executor.submit(self._put_sync, key, info)
+
+    async def close(self):
+        """等待未完成的写入，然后关闭数据库"""
+        if self._closed:
+            return
+        self._closed = True
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._close_sync)
+        self._executor.shutdown(wait=False)
+
+    def get_stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+    def _get_conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            conn = sqlite3.connect(self._path)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS beatmap_info ('
+                'mapid_type TEXT NOT NULL, '
+                'mapid_num INTEGER NOT NULL, '
+                'info TEXT NOT NULL, '
+                'update_time INTEGER NOT NULL, '
+                'PRIMARY KEY (mapid_type, mapid_num)'
+                ') WITHOUT ROWID'
+            )
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _get_sync(self, key: Tuple[str, int]) -> Optional[dict]:
+        try:
+            row = self._get_conn().execute(
+                'SELECT info FROM beatmap_info WHERE mapid_type = ? AND mapid_num = ?', key
+            ).fetchone()
+            if row is None:
+                return None
+            return json_codec.loads(row[0])
+        except (sqlite3.Error, OSError, ValueError):
+            logger.exception('InfoStore get failed, key=%s', key)
+            return None
+
+    def _put_sync(self, key: Tuple[str, int], info: dict):
+        try:
+            conn = self._get_conn()
+            conn.execute(
+                'INSERT OR REPLACE INTO beatmap_info (mapid_type, mapid_num, info, update_time) VALUES (?, ?, ?, ?)',
+                (*key, json_codec.dumps(info), int(time.time()))
+            )
+            conn.commit()
+        except (sqlite3.Error, OSError, TypeError, ValueError):
+            logger.exception('InfoStore put failed, key=%s', key)
+
+    def _close_sync(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
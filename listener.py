@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
+import collections
 import datetime
+import functools
 import logging
+import time
 import os
 import sys
 from typing import *
@@ -9,17 +12,55 @@ import blcsdk
 import blcsdk.models as sdk_models
 import config
 import asyncio
+from info_api import MapId
 from osu_irc import send_beatmap_url
 import re
-from osu_irc import AsyncIRCClient
+from osu_irc import AsyncIRCClient, TokenBucket
 import subprocess
+from history import RequestHistory
+from room_log import RoomLogWriter
+from supervisor import TaskSupervisor
 
 logger = logging.getLogger('osu-requests-bot.' + __name__)
 
+# 点歌限流用的结构的容量上限，刷屏时内存也不会无限增长
+MAX_TRACKED_USERS = 1024
+"""每个直播间最多记录多少个观众的令牌桶，超过后淘汰最久没点歌的"""
+MAX_TRACKED_MAPS = 256
+"""每个直播间最多记录多少张最近点过的图，超过后淘汰最早的"""
+
+# 点歌请求处理的并发和排队上限，排队满了之后新的请求会被丢弃
+MAX_CONCURRENT_REQUESTS = 4
+MAX_PENDING_REQUESTS = 100
+SHUT_DOWN_DRAIN_TIMEOUT = 10
+"""退出时最多等待多少秒让已经收到的点歌请求处理完"""
+
+# 点歌请求的处理结果，记录在点歌记录里
+OUTCOME_SENT = 'sent'
+"""发送成功"""
+OUTCOME_NO_INFO = 'no_info'
+"""没有获取到谱面信息，只发送了链接"""
+OUTCOME_SEND_FAILED = 'send_failed'
+"""发送失败或者发送队列满了"""
+OUTCOME_ERROR = 'error'
+"""处理时出现异常"""
+OUTCOME_THROTTLED = 'throttled'
+"""点歌太频繁被忽略"""
+OUTCOME_DUPLICATE = 'duplicate'
+"""重复点同一张图被忽略"""
+OUTCOME_OVERLOADED = 'overloaded'
+"""请求太多处理不过来被丢弃"""
+
 _msg_handler: Optional['MsgHandler'] = None
 _id_room_dict: Dict[int, 'Room'] = {}
 
 _irc_client: Optional[AsyncIRCClient] = None
+_request_supervisor: Optional[TaskSupervisor] = None
+_room_log_writer: Optional[RoomLogWriter] = None
+_request_history = RequestHistory()
+"""点歌记录，用history.py查询"""
+_pending_sends: Set[asyncio.Future] = set()
+"""已经提交到IRC点歌队列、还没有发送结果的点歌请求"""
 
 async def init(irc_client: Optional[AsyncIRCClient] = None, event:asyncio.Event|None = None):
     global _msg_handler
@@ -32,6 +73,14 @@ async def init(irc_client: Optional[AsyncIRCClient] = None, event:asyncio.Event|
     global _irc_client
     _irc_client = irc_client
 
+    global _request_supervisor
+    _request_supervisor = TaskSupervisor('beatmap-requests', MAX_CONCURRENT_REQUESTS, MAX_PENDING_REQUESTS)
+    _request_supervisor.start()
+
+    global _room_log_writer
+    _room_log_writer = RoomLogWriter()
+    _room_log_writer.start()
+
     # 创建已有的房间。这一步失败了也没关系，只是有消息时才会创建文件
     try:
         blc_rooms = await blcsdk.get_rooms()
@@ -42,27 +91,76 @@ async def init(irc_client: Optional[AsyncIRCClient] = None, event:asyncio.Event|
         pass
 
 
-def shut_down():
+async def shut_down():
     blcsdk.set_msg_handler(None)
+    # 先处理完已经收到的点歌请求，房间日志要在这之后再关
+    start_time = time.monotonic()
+    if _request_supervisor is not None:
+        await _request_supervisor.shut_down(SHUT_DOWN_DRAIN_TIMEOUT)
+    # 已经提交到IRC点歌队列的请求等有了发送结果、记进点歌记录后再关，和上面共用等待时间
+    if _pending_sends:
+        timeout = max(SHUT_DOWN_DRAIN_TIMEOUT - (time.monotonic() - start_time), 0)
+        await asyncio.wait(list(_pending_sends), timeout=timeout)
+    await _request_history.close()
     while len(_id_room_dict) != 0:
         room_id = next(iter(_id_room_dict))
         _del_room(room_id)
+    if _room_log_writer is not None:
+        await _room_log_writer.close()
+    logger.info('Request stats: %s', get_stats())
+
 
-def get_mapid(danmu_text:str) -> str|None:
-    # 收到明确表名为sid或bid
-    match = re.match(r"^(?:点歌[\s]?/?)?([bBsS]\d+)",danmu_text)
-    if match:
-        return match.group(1).lower()
+def get_stats() -> dict:
+    """取点歌请求处理的统计信息，包括排队数、正在获取谱面信息的数量和等待发送的数量"""
+    if _request_supervisor is None:
+        return {}
+    return {
+        **_request_supervisor.get_stats(),
+        'sending_count': len(_pending_sends),
+        'room_log': _room_log_writer.get_stats(),
+    }
 
-    # 只发了纯数字，处理为bid
-    match = re.match(r"^点歌[\s]?/?(\d+)",danmu_text)
-    if match:
-        return f"b{match.group(1)}"
+_MAPID_FIRST_CHARS = frozenset('点bBsSho')
+"""点歌弹幕可能的第一个字符，除此之外只有数字开头的才可能是点歌"""
+_MAPID_PATTERN = re.compile(
+    # 谱面链接，前面可以有点歌前缀：
+    # osu.ppy.sh/beatmapsets/sid#mode/bid、osu.ppy.sh/beatmapsets/sid、osu.ppy.sh/s/sid、
+    # osu.ppy.sh/beatmaps/bid、osu.ppy.sh/b/bid
+    r"^(?:(?:点歌\s?/?)?(?:https?://)?osu\.ppy\.sh/"
+    r"(?:(?:beatmapsets|s)/(?P<url_sid>\d+)(?:/?#(?P<url_mode>\w+)/(?P<url_bid>\d+))?"
+    r"|(?:beatmaps|b)/(?P<url_b>\d+))"
+    # 点歌 + 明确表明为sid或bid / 点歌 + 纯数字（处理为bid）
+    r"|点歌\s?/?(?:(?P<id1>[bBsS]\d+)|(?P<num1>\d+))"
+    # 没有点歌前缀时明确表明为sid或bid
+    r"|(?P<id2>[bBsS]\d+)"
+    # 如果用户输入连 点歌 前缀都没有则要求消息只有是纯数字的时候才能匹配，处理为bid
+    r"|(?P<num2>\d+)$)"
+)
 
-    # 如果用户输入连 点歌 前缀都没有则要求消息只有是纯数字的时候才能匹配
-    match = re.match(r"^(\d+)$", danmu_text)
-    if match:
-        return f"b{match.group(1)}"
+def get_mapid(danmu_text:str) -> MapId|None:
+    # 绝大多数弹幕不是点歌，只看第一个字符就能排除。\d匹配的就是isdecimal()为True的字符
+    first_char = danmu_text[:1]
+    if first_char not in _MAPID_FIRST_CHARS and not first_char.isdecimal():
+        return None
+
+    match = _MAPID_PATTERN.match(danmu_text)
+    if match is None:
+        return None
+    groups = match.groupdict()
+    if groups["url_sid"] is not None:
+        sid = int(groups["url_sid"])
+        if groups["url_bid"] is not None:
+            return MapId("b", int(groups["url_bid"]), sid, groups["url_mode"])
+        return MapId("s", sid, sid)
+    if groups["url_b"] is not None:
+        return MapId("b", int(groups["url_b"]))
+
+    mapid = groups["id1"] or groups["id2"]
+    if mapid is not None:
+        mapid_type = mapid[0].lower()
+        mapid_num = int(mapid[1:])
+        return MapId(mapid_type, mapid_num, mapid_num if mapid_type == "s" else None)
+    return MapId("b", int(groups["num1"] or groups["num2"]))
 
 class MsgHandler(blcsdk.BaseHandler):
     def on_client_stopped(self, client: blcsdk.BlcPluginClient, exception: Optional[Exception]):
@@ -99,8 +197,18 @@ class MsgHandler(blcsdk.BaseHandler):
         if map_id:
             room = _get_or_add_room(extra.room_id)
             room.log(f"{message.author_name}发送了点歌请求：{map_id}")
+            uid = message.uid or message.author_name
+            outcome = room.throttle.check(uid, str(map_id))
+            if outcome is not None:
+                if outcome == OUTCOME_THROTTLED:
+                    reason = '点歌太频繁'
+                else:
+                    reason = f'{config.MAP_DEDUPE_WINDOW:g}秒内已经点过这张图'
+                room.log(f"{message.author_name}的点歌请求{map_id}被忽略：{reason}")
+                _request_history.record(room.room_id, uid, message.author_name, str(map_id), outcome)
+                return
             if _irc_client:
-                asyncio.create_task(send_beatmap_url(_irc_client, str(map_id), message.author_name))
+                _submit_request(room, uid, message.author_name, map_id)
 
     def _on_add_super_chat(
         self, client: blcsdk.BlcPluginClient, message: sdk_models.AddSuperChatMsg, extra: sdk_models.ExtraData
@@ -111,8 +219,51 @@ class MsgHandler(blcsdk.BaseHandler):
         if map_id:
             room = _get_or_add_room(extra.room_id)
             room.log(f"{message.author_name} 发送了 {message.price} 元的点歌请求：{map_id}")
+            # 醒目留言不限流，但是算作点过这张图
+            room.throttle.record_map(str(map_id))
             if _irc_client:
-                asyncio.create_task(send_beatmap_url(_irc_client, str(map_id), message.author_name))
+                _submit_request(room, message.uid or message.author_name, message.author_name, map_id, message.price)
+
+def _submit_request(room: 'Room', uid: str, author_name: str, map_id: MapId, price: Optional[float] = None):
+    if not _request_supervisor.submit(_handle_request(room, uid, author_name, map_id, price)):
+        room.log('点歌请求太多，处理不过来，请求被丢弃')
+        _request_history.record(room.room_id, uid, author_name, str(map_id), OUTCOME_OVERLOADED)
+
+async def _handle_request(room: 'Room', uid: str, author_name: str, map_id: MapId, price: Optional[float]):
+    """
+    获取谱面信息并提交到IRC点歌队列。只有这部分占用处理的并发数，排队发送在IRC点歌队列里按优先级进行，
+    发送结果出来后再记进点歌记录
+    """
+    start_time = time.monotonic()
+    try:
+        info, sent_future = await send_beatmap_url(_irc_client, map_id, author_name, price)
+    except Exception:
+        _request_history.record(room.room_id, uid, author_name, str(map_id), OUTCOME_ERROR)
+        raise
+    _pending_sends.add(sent_future)
+    sent_future.add_done_callback(
+        functools.partial(_on_request_sent, room.room_id, uid, author_name, map_id, info, start_time)
+    )
+
+
+def _on_request_sent(
+    room_id: int, uid: str, author_name: str, map_id: MapId, info: Optional[dict], start_time: float,
+    sent_future: asyncio.Future
+):
+    _pending_sends.discard(sent_future)
+    sent = not sent_future.cancelled() and sent_future.result()
+    if not sent:
+        outcome = OUTCOME_SEND_FAILED
+    elif info is None:
+        outcome = OUTCOME_NO_INFO
+    else:
+        outcome = OUTCOME_SENT
+    _request_history.record(
+        room_id, uid, author_name, str(map_id), outcome,
+        sid=info['sid'] if info else map_id.sid,
+        server=info['server'] if info else None,
+        latency=time.monotonic() - start_time,
+    )
 
 def _get_or_add_room(room_id):
     room = _id_room_dict.get(room_id, None)
@@ -129,19 +280,99 @@ def _del_room(room_id):
         room.close()
 
 
+class RequestThrottle:
+    """
+    一个直播间的点歌限流  
+    每个观众一个令牌桶，限制连续点歌；同一张图在滑动窗口内只处理第一次。两者都有容量上限，按LRU淘汰
+    """
+    def __init__(self):
+        self._user_buckets: collections.OrderedDict[str, TokenBucket] = collections.OrderedDict()
+        self._recent_maps: collections.OrderedDict[str, float] = collections.OrderedDict()
+        """map_id -> 最后一次被处理的时间，按时间排序"""
+
+        self.user_suppressed_count = 0
+        """因为点歌太频繁被忽略的请求数"""
+        self.map_suppressed_count = 0
+        """因为重复点同一张图被忽略的请求数"""
+
+    def check(self, uid: str, map_id: str) -> Optional[str]:
+        """
+        检查是否处理这个点歌请求，处理的话会消耗令牌并记录这张图
+
+        :return: 忽略的原因OUTCOME_DUPLICATE或OUTCOME_THROTTLED，处理则返回None
+        """
+        if self._is_recent_map(map_id):
+            self.map_suppressed_count += 1
+            return OUTCOME_DUPLICATE
+
+        if config.USER_REQUEST_BURST > 0:
+            bucket = self._user_buckets.get(uid, None)
+            if bucket is None:
+                bucket = TokenBucket(config.USER_REQUEST_BURST, 1 / max(config.USER_REQUEST_INTERVAL, 0.001))
+                self._user_buckets[uid] = bucket
+                if len(self._user_buckets) > MAX_TRACKED_USERS:
+                    self._user_buckets.popitem(last=False)
+            else:
+                self._user_buckets.move_to_end(uid)
+            if not bucket.try_acquire():
+                self.user_suppressed_count += 1
+                return OUTCOME_THROTTLED
+
+        self.record_map(map_id)
+        return None
+
+    def record_map(self, map_id: str):
+        if config.MAP_DEDUPE_WINDOW <= 0:
+            return
+        self._recent_maps[map_id] = time.monotonic()
+        self._recent_maps.move_to_end(map_id)
+        if len(self._recent_maps) > MAX_TRACKED_MAPS:
+            self._recent_maps.popitem(last=False)
+
+    def _is_recent_map(self, map_id: str) -> bool:
+        if config.MAP_DEDUPE_WINDOW <= 0:
+            return False
+        # 按时间排序，先清掉窗口外的
+        min_time = time.monotonic() - config.MAP_DEDUPE_WINDOW
+        while self._recent_maps:
+            oldest_map_id, last_time = next(iter(self._recent_maps.items()))
+            if last_time >= min_time:
+                break
+            del self._recent_maps[oldest_map_id]
+        return map_id in self._recent_maps
+
+    def get_stats(self) -> dict:
+        return {
+            'tracked_users': len(self._user_buckets),
+            'tracked_maps': len(self._recent_maps),
+            'user_suppressed_count': self.user_suppressed_count,
+            'map_suppressed_count': self.map_suppressed_count,
+        }
+
+
 class Room:
     def __init__(self, room_id):
         cur_time = datetime.datetime.now()
         time_str = cur_time.strftime('%Y%m%d_%H%M%S')
         filename = f'room_{room_id}-{time_str}.txt'
-        self._file = open(os.path.join(config.LOG_PATH, filename), 'a', encoding='utf-8-sig')
+        # 文件在第一次写入时才创建
+        self._path = os.path.join(config.LOG_PATH, filename)
+        self.room_id = room_id
+        self.throttle = RequestThrottle()
 
     def close(self):
-        self._file.close()
+        stats = self.throttle.get_stats()
+        if stats['user_suppressed_count'] or stats['map_suppressed_count']:
+            self.log(
+                f"共忽略了{stats['user_suppressed_count']}个太频繁的点歌请求，"
+                f"{stats['map_suppressed_count']}个重复的点歌请求"
+            )
+        # 缓冲里还没写的行会先写完再关闭
+        _room_log_writer.close_file(self._path)
 
     def log(self, content):
         cur_time = datetime.datetime.now()
         time_str = cur_time.strftime('%Y-%m-%d %H:%M:%S')
         text = f'{time_str} {content}\n'
-        self._file.write(text)
-        self._file.flush()
+        # 文件写入在后台线程批量执行，不阻塞接收消息
+        _room_log_writer.write(self._path, text)
@@ -1,22 +1,39 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import asyncio
+import atexit
+import datetime
 import logging.handlers
 import os
+import queue
 import signal
 import sys
+import threading
+import time
 from typing import *
 
 import blcsdk
 import config
+import info_api
 import listener
+from blcsdk import json_codec
 from osu_irc import AsyncIRCClient
 
 logger = logging.getLogger('osu-requests-bot')
 
+LOG_QUEUE_SIZE = 10000
+"""日志队列最多放多少条，输出跟不上时丢弃新的日志，不会阻塞调用logger的地方"""
+LOG_STOP_TIMEOUT = 5
+"""退出时最多等待多少秒输出队列里剩下的日志"""
+STATS_LOG_INTERVAL = 10 * 60
+"""每隔多少秒在日志里输出一次统计信息"""
+
 shut_down_event: Optional[asyncio.Event] = None
 irc_client: Optional[AsyncIRCClient] = None
 irc_task: Optional[asyncio.Task] = None
+log_queue_handler: Optional['DroppingQueueHandler'] = None
+log_listener: Optional['BoundedQueueListener'] = None
+stats_task: Optional[asyncio.Task] = None
 
 async def main():
     try:
@@ -36,6 +53,9 @@ async def init():
     await blcsdk.init()
     if not blcsdk.is_sdk_version_compatible():
         raise RuntimeError('SDK version is not compatible')
+
+    # 初始化获取谱面信息用的连接池
+    await info_api.init()
   # 初始化 IRC 客户端（长连接）
     global irc_client, irc_task
     if getattr(config, 'USER_NAME', None):
@@ -73,28 +93,161 @@ def start_shut_down(*_args):
 
 def init_logging():
     filename = os.path.join(config.LOG_PATH, 'msg-logging.log')
+    text_formatter = logging.Formatter('{asctime} {levelname} [{name}]: {message}', style='{')
     stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(text_formatter)
     file_handler = logging.handlers.TimedRotatingFileHandler(
         filename, encoding='utf-8', when='midnight', backupCount=7, delay=True
     )
+    file_handler.setFormatter(JsonFormatter() if getattr(config, 'LOG_JSON', False) else text_formatter)
+
+    # 控制台和文件的输出都在单独的线程里执行，stdout被blivechat的管道堵住时也不会卡住事件循环
+    global log_queue_handler
+    log_queue_handler = queue_handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    # 放进队列前只合并参数和异常信息，格式化交给真正输出的handler
+    queue_handler.setFormatter(logging.Formatter())
     logging.basicConfig(
-        format='{asctime} {levelname} [{name}]: {message}',
-        style='{',
         level=logging.INFO,
         # level=logging.DEBUG,
-        handlers=[stream_handler, file_handler],
+        handlers=[queue_handler],
     )
 
+    global log_listener
+    log_listener = BoundedQueueListener(
+        queue_handler.queue, stream_handler, file_handler, respect_handler_level=True
+    )
+    log_listener.start()
+
+
+def stop_logging():
+    """输出队列里剩下的日志，然后停止日志线程，输出被堵住时最多等待LOG_STOP_TIMEOUT秒"""
+    global log_listener
+    if log_listener is None:
+        return
+    dropped_count = log_queue_handler.dropped_count
+    if dropped_count != 0:
+        logger.warning('Log queue was full, dropped %d log records', dropped_count)
+        if log_queue_handler.dropped_count != dropped_count:
+            # 这条也被丢弃了
+            print(f'Log queue was full, dropped {dropped_count} log records', file=sys.stderr)
+
+    if not log_listener.stop(LOG_STOP_TIMEOUT):
+        # 日志线程卡在输出里，拿着handler的锁，退出时logging.shutdown要拿同一个锁也会一直卡住。
+        # 剩下的日志已经放弃了，不用它再flush和关闭handler
+        atexit.unregister(logging.shutdown)
+    log_listener = None
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """队列满时丢弃日志并计数，不阻塞调用方"""
+
+    def __init__(self, queue_: queue.Queue):
+        super().__init__(queue_)
+        self.dropped_count = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped_count += 1
+
+
+class BoundedQueueListener(logging.handlers.QueueListener):
+    """
+    停止时有等待时间上限的QueueListener
+
+    QueueListener.stop会一直等到日志线程输出完队列里的日志，stdout被堵住时进程就退不出了。这里自己管理日志线程，
+    等待超时后标记为放弃，日志线程恢复后也不再输出剩下的日志
+    """
+
+    _STOP = object()
+    """放进队列里让日志线程退出"""
+
+    def __init__(self, queue_: queue.Queue, *handlers, respect_handler_level=False):
+        super().__init__(queue_, *handlers, respect_handler_level=respect_handler_level)
+        self._log_thread: Optional[threading.Thread] = None
+        self.abandoned = False
+        """停止时等待超时，剩下的日志不再输出"""
+
+    def start(self):
+        self._log_thread = threading.Thread(target=self._run, name='log-listener', daemon=True)
+        self._log_thread.start()
+
+    def stop(self, timeout: float = LOG_STOP_TIMEOUT) -> bool:
+        """
+        输出队列里剩下的日志，然后停止日志线程，最多等待timeout秒
+
+        :return: 是否在timeout秒内停止了，超时的话日志线程是daemon线程，不用管它
+        """
+        if self._log_thread is None:
+            return True
+        deadline = time.monotonic() + timeout
+        try:
+            self.queue.put(self._STOP, timeout=timeout)
+        except queue.Full:
+            pass
+        else:
+            self._log_thread.join(max(deadline - time.monotonic(), 0))
+        stopped = not self._log_thread.is_alive()
+        if not stopped:
+            self.abandoned = True
+        self._log_thread = None
+        return stopped
+
+    def handle(self, record):
+        if not self.abandoned:
+            super().handle(record)
+
+    def _run(self):
+        while True:
+            record = self.dequeue(True)
+            if record is self._STOP:
+                break
+            self.handle(record)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    每条日志输出成一行JSON，方便用工具分析  
+    异常信息已经在放进队列时合并到message里了
+    """
+
+    def format(self, record):
+        return json_codec.dumps({
+            'time': datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'name': record.name,
+            'message': record.getMessage(),
+        })
+
 
 async def run():
+    global stats_task
+    stats_task = asyncio.create_task(log_stats())
     logger.info('Running event loop')
     await shut_down_event.wait()
     logger.info('Start to shut down')
 
 
+async def log_stats():
+    """定时输出IRC发送（速率、排队时间、RTT等）、点歌请求处理和谱面信息缓存的统计信息"""
+    while True:
+        await asyncio.sleep(STATS_LOG_INTERVAL)
+        if irc_client is not None:
+            logger.info('IRC stats: %s', irc_client.get_stats())
+        logger.info('Request stats: %s', listener.get_stats())
+        logger.info('Beatmap info cache stats: %s', info_api.info_cache.get_stats())
+
+
 async def shut_down():
-    listener.shut_down()
+    if stats_task is not None:
+        stats_task.cancel()
+    await listener.shut_down()
+    if irc_client is not None:
+        await irc_client.close()
+    await info_api.shut_down()
     await blcsdk.shut_down()
+    stop_logging()
 
 
 if __name__ == '__main__':
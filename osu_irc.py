@@ -2,16 +2,214 @@ import socket
 import time
 import logging
 
-from info_api import get_info as get_beatmap_info
+from info_api import MapId, get_info as get_beatmap_info
 import asyncio
+import collections
 import config
-from typing import Optional
+import dataclasses
+import heapq
+import random
+from collections.abc import Awaitable, Callable, Container
+from typing import NamedTuple, Optional
 
 
 logger = logging.getLogger('osu-requests-bot.' + __name__)
 
+# 速率限制：ppy说每5秒最多10条消息
+# 令牌桶在任意5秒内最多发送 SEND_BURST + 5 * SEND_RATE 条，默认正好是10条
+SEND_BURST = 5
+SEND_RATE = 1.0
+
+# 根据Bancho的反馈调整发送速率（AIMD）：每成功发送一条速率增加RATE_INCREASE_STEP条/秒，最多到SEND_RATE；
+# 收到刷屏警告时速率乘以RATE_DECREASE_FACTOR，最低MIN_SEND_RATE。一次刷屏可能收到多条警告，RATE_BACKOFF_HOLD秒内只降速一次
+MIN_SEND_RATE = 0.1
+RATE_INCREASE_STEP = 0.02
+RATE_DECREASE_FACTOR = 0.5
+RATE_BACKOFF_HOLD = 5.0
+FLOOD_WARNING_SENDERS = ("BanchoBot",)
+"""发送刷屏警告的用户，没有用户部分的前缀（服务器本身）也算"""
+FLOOD_WARNING_KEYWORDS = ("too fast", "too quickly", "flood", "slow down", "rate limit", "silenced")
+"""刷屏警告里会出现的关键字，不区分大小写"""
+
+# 断线期间最多缓存多少条消息，超过后新的消息会被丢弃
+SEND_BUFFER_SIZE = 100
+
+# 点歌优先级：普通弹幕为PRIORITY_TEXT，醒目留言为PRIORITY_SUPER_CHAT加上每元PRIORITY_PER_PRICE。
+# 排队时每秒优先级增加AGING_RATE，避免普通弹幕一直被醒目留言插队。默认等了60秒的普通弹幕和刚到的0元醒目留言一样优先
+PRIORITY_TEXT = 0.0
+PRIORITY_SUPER_CHAT = 60.0
+PRIORITY_PER_PRICE = 1.0
+AGING_RATE = 1.0
+
+# 断线重连的等待时间，指数增长并加上随机抖动
+RECONNECT_BASE_DELAY = 1.0
+RECONNECT_MAX_DELAY = 60.0
+RECONNECT_MAX_EXPONENT = 16
+"""计算等待时间时指数的上限，默认设置下2 ** 6就已经超过最大等待时间了"""
+
+# 连接保活：超过PING_IDLE_INTERVAL秒没有收到任何消息就主动发PING，
+# 发PING后超过PING_TIMEOUT秒还没有收到任何消息则认为连接已经断了，强制重连
+PING_IDLE_INTERVAL = 30.0
+PING_TIMEOUT = 20.0
+
+# IRC协议规定一行最多512字节（包括结尾的\r\n），服务器转发时还会加上发送者前缀，这里留出余量
+MAX_LINE_BYTES = 512
+LINE_PREFIX_MARGIN = 64
+
+class IRCMessage(NamedTuple):
+    """解析后的IRC消息"""
+    prefix: str|None
+    """消息来源，例如 BanchoBot!cho@ppy.sh，没有前缀时为None"""
+    command: str
+    """命令或者三位数字的回复码，统一为大写"""
+    params: list[str]
+    """参数，最后一个参数可以包含空格"""
+
+def parse_irc_line(line:bytes, commands:Container[bytes]|None = None) -> IRCMessage|None:
+    """
+    按RFC 1459解析一行IRC消息  
+    commands不为None时，命令不在commands里的行不解码直接返回None  
+    格式：[':' prefix ' '] command {' ' param} [' :' trailing]
+    """
+    # 先只切出命令判断要不要处理，大部分消息到这里就跳过了
+    pos = 0
+    if line.startswith(b":"):
+        pos = line.find(b" ") + 1
+        if pos == 0:
+            return None
+    end = line.find(b" ", pos)
+    if end < 0:
+        line = line.rstrip(b"\r\n")
+        end = len(line)
+    command = line[pos:end]
+    if commands is not None and command not in commands:
+        # 命令不区分大小写，服务器一般都发大写
+        if command.isupper() or command.isdigit():
+            return None
+        command = command.upper()
+        if command not in commands:
+            return None
+    else:
+        command = command.upper()
+    if not command:
+        return None
+
+    prefix = line[1:pos - 1] if pos > 0 else None
+    rest = line[end + 1:].rstrip(b"\r\n")
+    trailing = None
+    if rest.startswith(b":"):
+        trailing = rest[1:]
+        rest = b""
+    else:
+        pos = rest.find(b" :")
+        if pos >= 0:
+            trailing = rest[pos + 2:]
+            rest = rest[:pos]
+    params = rest.split()
+    if trailing is not None:
+        params.append(trailing)
+
+    return IRCMessage(
+        prefix.decode(errors="replace") if prefix is not None else None,
+        command.decode(errors="replace"),
+        [param.decode(errors="replace") for param in params],
+    )
+
+class TokenBucket:
+    """
+    令牌桶限速器  
+    最多积攒burst个令牌，每秒补充rate个，发送一条消息消耗一个令牌
+    """
+    def __init__(self, burst: float, rate: float):
+        self.burst = burst
+        self.rate = rate
+        self._tokens = burst
+        self._last_time = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last_time) * self.rate)
+        self._last_time = now
+
+    def set_rate(self, rate: float):
+        """修改补充速率，之前积攒的令牌按旧速率计算"""
+        self._refill()
+        self.rate = rate
+
+    def clear(self):
+        """清空已经积攒的令牌"""
+        self._refill()
+        self._tokens = 0.0
+
+    def try_acquire(self) -> bool:
+        """有令牌则消耗一个并返回True，否则返回False"""
+        self._refill()
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    def time_until_available(self) -> float:
+        """距离下一个令牌可用还有多少秒"""
+        self._refill()
+        return max(0.0, (1 - self._tokens) / self.rate)
+
+    async def acquire(self):
+        """等待并消耗一个令牌"""
+        while not self.try_acquire():
+            await asyncio.sleep(self.time_until_available())
+
+class AIMDRateController:
+    """
+    加性增、乘性减的发送速率控制器，调整令牌桶的补充速率  
+    一切正常时慢慢提高到max_rate，收到刷屏警告时立即减半并清空令牌
+    """
+    def __init__(self, bucket: TokenBucket, max_rate: float, min_rate: float = MIN_SEND_RATE,
+                 increase_step: float = RATE_INCREASE_STEP, decrease_factor: float = RATE_DECREASE_FACTOR,
+                 backoff_hold: float = RATE_BACKOFF_HOLD):
+        self._bucket = bucket
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.backoff_hold = backoff_hold
+        self._last_backoff_time: Optional[float] = None
+
+        self.backoff_count = 0
+        """降速次数"""
+
+    @property
+    def rate(self) -> float:
+        """当前速率（条/秒）"""
+        return self._bucket.rate
+
+    def on_sent(self):
+        """成功发送了一条消息"""
+        if self.rate < self.max_rate:
+            self._bucket.set_rate(min(self.max_rate, self.rate + self.increase_step))
+
+    def on_warning(self):
+        """收到刷屏警告"""
+        now = time.monotonic()
+        if self._last_backoff_time is not None and now - self._last_backoff_time < self.backoff_hold:
+            return
+        self._last_backoff_time = now
+        self.backoff_count += 1
+        self._bucket.set_rate(max(self.min_rate, self.rate * self.decrease_factor))
+        self._bucket.clear()
+        logger.warning(f"IRC: 收到刷屏警告，发送速率降低到 {self.rate:.2f} 条/秒")
+
+@dataclasses.dataclass
+class OutgoingMessage:
+    """发送队列里的一条消息"""
+    target: str
+    text: str
+    future: asyncio.Future
+    """消息发送出去后结果为True，发送失败为False"""
+
 class AsyncIRCClient:
-    def __init__(self, host: str, port: int, nick: str, realname: str = None, password: str = None):
+    def __init__(self, host: str, port: int, nick: str, realname: str = None, password: str = None,
+                 send_burst: float = SEND_BURST, send_rate: float = SEND_RATE):
         self.host = host
         self.port = port
         self.nick = nick
@@ -22,12 +220,61 @@ class AsyncIRCClient:
         self.running = True
         self._connected = asyncio.Event()
 
+        # 发送队列，由_writer_loop按令牌桶限速依次发送
+        self._send_bucket = TokenBucket(send_burst, send_rate)
+        self._rate_controller = AIMDRateController(self._send_bucket, send_rate)
+        self._send_queue: collections.deque[OutgoingMessage] = collections.deque()
+        self._send_queue_event = asyncio.Event()
+        self._writer_task: Optional[asyncio.Task] = None
+
+        # 断线重连的统计
+        self._reconnect_attempt = 0
+        """登录成功之前连续重连的次数，用来计算等待时间"""
+        self._disconnect_time: Optional[float] = None
+        """最近一次断线的时间"""
+        self.reconnect_count = 0
+        """断线后重新登录成功的次数"""
+        self.last_recovery_time: Optional[float] = None
+        """最近一次从断线到重新登录成功用了多少秒"""
+        self.dropped_count = 0
+        """因为缓存满了被丢弃的消息数"""
+
+        # 连接保活
+        self._watchdog_task: Optional[asyncio.Task] = None
+        self._last_recv_time = time.monotonic()
+        """最后一次收到消息的时间"""
+        self._ping_token: Optional[str] = None
+        """还没收到回复的PING的token"""
+        self._ping_sent_time = 0.0
+        self._ping_count = 0
+        self.last_rtt: Optional[float] = None
+        """最近一次PING的往返时间（秒）"""
+        self.watchdog_reconnect_count = 0
+        """因为PING超时强制重连的次数"""
+
+        self.beatmap_batcher = BeatmapBatcher(self)
+        """点歌消息的合并发送队列"""
+
+        self._handlers: dict[bytes, Callable[[IRCMessage], Awaitable[None]]] = {
+            b"PING": self._on_ping,
+            b"PONG": self._on_pong,
+            b"001": self._on_welcome,  # RPL_WELCOME
+            b"ERROR": self._on_error,
+            b"NOTICE": self._on_notice,
+            b"PRIVMSG": self._on_notice,
+        }
+        """命令 -> 处理函数，不在这里的消息不解码直接忽略"""
+
     async def connect(self):
         """长连接主循环"""
+        if self._writer_task is None:
+            self._writer_task = asyncio.create_task(self._writer_loop())
+        self.beatmap_batcher.start()
         while self.running:
             try:
                 logger.info(f"IRC: 连接到 {self.host}:{self.port}")
                 self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+                self._start_watchdog()
 
                 # 认证
                 if self.password:
@@ -36,80 +283,492 @@ class AsyncIRCClient:
                 self.writer.write(f"USER {self.nick} 0 * :{self.realname}\r\n".encode())
                 await self.writer.drain()
 
-                # 等待欢迎消息（表示登录成功）
-                async for line in self.reader:
-                    msg = line.decode(errors='ignore').strip()
-                    if msg.startswith("PING"):
-                        token = msg.split()[1]
-                        await self._send_raw(f"PONG {token}")
-                    elif "001" in msg:  # RPL_WELCOME
-                        logger.info("IRC: 登录成功")
-                        self._connected.set()
-                        break
-
-                # 进入主消息循环
+                # 进入主消息循环，收到欢迎消息表示登录成功
                 await self._message_loop()
 
             except Exception as e:
                 logger.error(f"IRC 连接错误: {e}")
-                if self.running:
-                    await asyncio.sleep(5)
             finally:
-                self._connected.clear()
-                if self.writer:
-                    self.writer.close()
-                    await self.writer.wait_closed()
+                await self._on_disconnect()
+
+            if self.running:
+                delay = self._get_reconnect_delay()
+                logger.info(f"IRC: {delay:.1f}秒后重连")
+                await asyncio.sleep(delay)
+
+    def _mark_disconnected(self):
+        if self._connected.is_set():
+            self._disconnect_time = time.monotonic()
+            self._connected.clear()
+
+    async def _on_disconnect(self):
+        self._stop_watchdog()
+        self._mark_disconnected()
+        await self._close_writer()
+
+    async def _close_writer(self):
+        """关闭连接，已经在关闭的不再关一次，对方重置连接等错误在断线时已经处理过了，这里忽略"""
+        if self.writer is None or self.writer.is_closing():
+            return
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (OSError, RuntimeError):
+            pass
+
+    def _get_reconnect_delay(self) -> float:
+        """指数退避，乘上0.5~1的随机系数避免和其他客户端同时重连"""
+        # 限制指数，连续失败很多次时2 ** attempt会大到无法转换成float
+        exponent = min(self._reconnect_attempt, RECONNECT_MAX_EXPONENT)
+        delay = min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** exponent)
+        self._reconnect_attempt += 1
+        return delay * random.uniform(0.5, 1.0)
 
     async def _message_loop(self):
         """处理 IRC 消息（保持连接）"""
         assert self.reader is not None
         async for line in self.reader:
-            msg = line.decode(errors='ignore').strip()
-            if msg.startswith("PING"):
-                token = msg.split()[1]
-                await self._send_raw(f"PONG {token}")
+            self._last_recv_time = time.monotonic()
+            msg = parse_irc_line(line, self._handlers)
+            if msg is not None:
+                await self._handlers[msg.command.encode()](msg)
+
+    async def _on_ping(self, msg:IRCMessage):
+        token = msg.params[-1] if msg.params else ""
+        await self._send_raw(f"PONG :{token}")
+
+    async def _on_pong(self, msg:IRCMessage):
+        if self._ping_token is not None and msg.params and msg.params[-1] == self._ping_token:
+            self.last_rtt = time.monotonic() - self._ping_sent_time
+            self._ping_token = None
+            logger.debug(f"IRC: PING往返时间 {self.last_rtt * 1000:.0f}ms")
+
+    def _start_watchdog(self):
+        self._stop_watchdog()
+        self._last_recv_time = time.monotonic()
+        self._ping_token = None
+        self._watchdog_task = asyncio.create_task(self._watchdog_loop())
+
+    def _stop_watchdog(self):
+        if self._watchdog_task is not None:
+            self._watchdog_task.cancel()
+            self._watchdog_task = None
+
+    async def _watchdog_loop(self):
+        """
+        连接保活  
+        半开的TCP连接可能很久都不会读到EOF，这期间发送的消息都会丢失，所以空闲时主动PING，收不到回复就强制断开重连
+        """
+        check_interval = min(PING_IDLE_INTERVAL, PING_TIMEOUT) / 4
+        while True:
+            await asyncio.sleep(check_interval)
+            now = time.monotonic()
+            if self._ping_token is not None:
+                if now - self._ping_sent_time < PING_TIMEOUT:
+                    continue
+                if self._last_recv_time < self._ping_sent_time:
+                    logger.warning(f"IRC: {now - self._last_recv_time:.0f}秒没有收到任何消息，强制重连")
+                    self.watchdog_reconnect_count += 1
+                    self._mark_disconnected()
+                    if self.writer:
+                        self.writer.transport.abort()
+                    return
+                # 没有收到PONG但是收到了其他消息，说明连接还活着
+                self._ping_token = None
+
+            if now - self._last_recv_time >= PING_IDLE_INTERVAL:
+                self._ping_count += 1
+                self._ping_token = f"watchdog{self._ping_count}"
+                self._ping_sent_time = now
+                try:
+                    await self._send_raw(f"PING :{self._ping_token}")
+                except (OSError, RuntimeError):
+                    pass
+
+    async def _on_welcome(self, msg:IRCMessage):
+        logger.info("IRC: 登录成功")
+        self._reconnect_attempt = 0
+        if self._disconnect_time is not None:
+            self.reconnect_count += 1
+            self.last_recovery_time = time.monotonic() - self._disconnect_time
+            self._disconnect_time = None
+            logger.info(f"IRC: 断线{self.last_recovery_time:.1f}秒后恢复，待发送消息{len(self._send_queue)}条")
+        self._connected.set()
+
+    async def _on_error(self, msg:IRCMessage):
+        logger.error(f"IRC: 服务器返回错误: {" ".join(msg.params)}")
+
+    async def _on_notice(self, msg:IRCMessage):
+        """检查BanchoBot或服务器发来的消息是不是刷屏警告"""
+        if msg.prefix is not None and "!" in msg.prefix:
+            if msg.prefix.split("!", 1)[0] not in FLOOD_WARNING_SENDERS:
+                return
+        if len(msg.params) < 2:
+            return
+        text = msg.params[-1].lower()
+        if any(keyword in text for keyword in FLOOD_WARNING_KEYWORDS):
+            logger.warning(f"IRC: <- {msg.prefix}: {msg.params[-1]}")
+            self._rate_controller.on_warning()
 
     async def _send_raw(self, message: str):
         if self.writer:
+            if self.writer.is_closing():
+                raise ConnectionResetError("IRC connection is closing")
             self.writer.write(f"{message}\r\n".encode())
             await self.writer.drain()
 
-    async def send_privmsg(self, target: str, message: str):
-        """发送私聊或频道消息"""
+    def get_stats(self) -> dict:
+        """取连接和发送队列的统计信息"""
+        return {
+            "connected": self._connected.is_set(),
+            "queue_size": len(self._send_queue),
+            "batcher_queue_size": self.beatmap_batcher.pending_count,
+            "queue_wait": self.beatmap_batcher.get_stats()["queue_wait"],
+            "reconnect_count": self.reconnect_count,
+            "last_recovery_time": self.last_recovery_time,
+            "dropped_count": self.dropped_count + self.beatmap_batcher.dropped_count,
+            "last_rtt": self.last_rtt,
+            "staleness": time.monotonic() - self._last_recv_time,
+            "watchdog_reconnect_count": self.watchdog_reconnect_count,
+            "send_rate": self._rate_controller.rate,
+            "rate_backoff_count": self._rate_controller.backoff_count,
+        }
+
+    def queue_privmsg(self, target: str, message: str) -> asyncio.Future:
+        """
+        把私聊或频道消息放进发送队列，断线期间的消息会在重新登录后发送  
+        返回的future在消息发送出去后结果为True，队列满了被丢弃时为False
+        """
+        future = asyncio.get_running_loop().create_future()
+        if len(self._send_queue) >= SEND_BUFFER_SIZE:
+            self.dropped_count += 1
+            logger.warning(f"IRC: 发送队列已满，丢弃消息：{message}")
+            future.set_result(False)
+            return future
         if not self._connected.is_set():
-            logger.warning("IRC: 尚未连接，无法发送消息")
-            return
-        # 速率限制：ppy说每5秒最多10条消息
-        await asyncio.sleep(0.5)
-        await self._send_raw(f"PRIVMSG {target} :{message}")
-        logger.info(f"IRC: -> {target}: {message}")
+            logger.info("IRC: 尚未连接，消息将在连接后发送")
+        self._send_queue.append(OutgoingMessage(target, message, future))
+        self._send_queue_event.set()
+        return future
+
+    async def send_privmsg(self, target: str, message: str) -> bool:
+        """发送私聊或频道消息，等待消息发送出去"""
+        return await self.queue_privmsg(target, message)
+
+    async def _writer_loop(self):
+        """唯一的发送协程，保证所有消息加起来不超过限速"""
+        while True:
+            # 调用方已经取消的消息不用发了
+            while self._send_queue and self._send_queue[0].future.done():
+                self._send_queue.popleft()
+            if not self._send_queue:
+                self._send_queue_event.clear()
+                await self._send_queue_event.wait()
+                continue
+
+            await self._connected.wait()
+            await self._send_bucket.acquire()
+            # 等待令牌的时候可能断线了
+            if not self._connected.is_set() or not self._send_queue:
+                continue
+
+            msg = self._send_queue.popleft()
+            if msg.future.done():
+                continue
+            try:
+                await self._send_raw(f"PRIVMSG {msg.target} :{msg.text}")
+            except (OSError, RuntimeError) as e:
+                # 放回队首，断开连接让主循环重连，重新登录后再发
+                logger.error(f"IRC: 发送消息失败，等待重连后重发: {e!r}")
+                self._send_queue.appendleft(msg)
+                self._mark_disconnected()
+                if self.writer:
+                    self.writer.transport.abort()
+                continue
+            logger.info(f"IRC: -> {msg.target}: {msg.text}")
+            self._rate_controller.on_sent()
+            msg.future.set_result(True)
 
     async def close(self):
+        logger.info(f"IRC统计：{self.get_stats()}")
         self.running = False
-        if self.writer:
-            self.writer.close()
-            await self.writer.wait_closed()
+        self._stop_watchdog()
+        self.beatmap_batcher.close()
+        if self._writer_task is not None:
+            self._writer_task.cancel()
+            self._writer_task = None
+        for msg in self._send_queue:
+            if not msg.future.done():
+                msg.future.set_result(False)
+        self._send_queue.clear()
+        await self._close_writer()
+
+@dataclasses.dataclass
+class BeatmapRequest:
+    """一个点歌请求，同一个谱面的多个请求会合并成一个"""
+    user_names: list[str]
+    mapid: str
+    info: dict|None
+    """谱面信息，获取失败时为None"""
+
+    @property
+    def merge_key(self) -> str:
+        """链接相同的请求可以合并"""
+        return self.info["url"] if self.info else self.mapid
+
+    def render(self, style:str = "full", max_names:int|None = None) -> str:
+        """
+        生成消息文本  
+        full   : 单独发送时使用，带完整的镜像站链接  
+        compact: 合并发送时使用，镜像站链接只保留短标签  
+        minimal: 一行放不下时去掉镜像站链接，只保留谱面链接  
+        link   : 还是放不下时连标题也去掉，只有谱面链接  
+        max_names不为None时最多写这么多个名字，后面加上"等N人"
+        """
+        names = self.user_names if max_names is None else self.user_names[:max_names]
+        user_names = "、".join(names)
+        if len(names) < len(self.user_names):
+            user_names += f"等{len(self.user_names)}人"
+        if not self.info:
+            # 如果无法正常获取谱面信息则直接返回链接，不考虑正确性
+            return f"【{user_names}】点歌：https://osu.ppy.sh/{self.mapid[0]}/{self.mapid[1:]}"
+
+        info = self.info
+        if style == "link":
+            return f"【{user_names}】点歌：{info["url"]}"
+        sid = info["sid"]
+        parts = [f"【{user_names}】点歌：[{info["url"]} {info["artist"]} - {info["title"]}]"]
+        if style == "full":
+            parts += [f"Sayo分流：[https://osu.sayobot.cn/home?search={sid} osu.sayobot.cn]",
+                      f"kitsu分流：[https://osu.direct/beatmapsets/{sid} osu.direct]"]
+        elif style == "compact":
+            parts += [f"[https://osu.sayobot.cn/home?search={sid} Sayo]",
+                      f"[https://osu.direct/beatmapsets/{sid} kitsu]"]
+        return " ".join(parts)
+
+def get_priority(price:float|None = None) -> float:
+    """取点歌请求的优先级，price为None表示普通弹幕，否则是醒目留言的金额（元）"""
+    if price is None:
+        return PRIORITY_TEXT
+    return PRIORITY_SUPER_CHAT + price * PRIORITY_PER_PRICE
+
+@dataclasses.dataclass(order=True)
+class PendingRequest:
+    """
+    排队中的点歌请求  
+    有效优先级是 priority + (now - enqueue_time) * AGING_RATE，所有请求的now相同，
+    所以按不随时间变化的 sort_key = enqueue_time * AGING_RATE - priority 从小到大排序就是按有效优先级从大到小
+    """
+    sort_key: float
+    seq: int
+    """sort_key相同时先来先发"""
+    target: str = dataclasses.field(compare=False)
+    request: BeatmapRequest = dataclasses.field(compare=False)
+    future: asyncio.Future = dataclasses.field(compare=False)
+    priority_class: str = dataclasses.field(compare=False)
+    enqueue_time: float = dataclasses.field(compare=False)
 
-async def send_beatmap_url(irc_client:AsyncIRCClient, mapid:str, user_name:str) -> None:
-    beatmapinfo:dict|None = await get_beatmap_info(mapid[0], int(mapid[1:]), config.API_SERVER)
+class BeatmapBatcher:
+    """
+    点歌消息的合并发送队列，在AsyncIRCClient.send_privmsg前面  
+    IRC发送队列里最多只放一行点歌消息，限速期间到达的请求在这里按优先级排队，下一行发送时把排队的请求尽量合并成一行：
+    同一个谱面的请求合并成一条，多个谱面用" | "连接，一行放不下时先去掉重复的镜像站链接
+    """
+    SEPARATOR = " | "
+
+    def __init__(self, irc_client:AsyncIRCClient):
+        self._irc_client = irc_client
+        self._pending: list[PendingRequest] = []
+        """按sort_key排列的堆"""
+        self._seq = 0
+        self._pending_event = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._wait_stats: dict[str, dict[str, float]] = {}
+        """优先级类别 -> 排队时间统计"""
+
+        self.request_count = 0
+        """提交的请求数"""
+        self.line_count = 0
+        """实际发送的行数"""
+        self.dropped_count = 0
+        """因为队列满了被丢弃的请求数"""
+
+    @property
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for item in self._pending:
+            if not item.future.done():
+                item.future.set_result(False)
+        self._pending.clear()
+
+    def submit(self, target:str, request:BeatmapRequest, priority:float = PRIORITY_TEXT,
+               priority_class:str = "text") -> asyncio.Future:
+        """
+        提交点歌请求  
+        返回的future在包含这个请求的消息发送出去后结果为True，发送失败时为False  
+        队列满时丢弃有效优先级最低的请求，可能是新的请求自己
+        """
+        future = asyncio.get_running_loop().create_future()
+        now = time.monotonic()
+        self._seq += 1
+        item = PendingRequest(now * AGING_RATE - priority, self._seq, target, request, future, priority_class, now)
+        if len(self._pending) >= SEND_BUFFER_SIZE:
+            lowest = max(self._pending)
+            if lowest < item:
+                lowest = item
+            else:
+                self._pending.remove(lowest)
+                heapq.heapify(self._pending)
+                heapq.heappush(self._pending, item)
+            self.dropped_count += 1
+            logger.warning(f"IRC: 点歌队列已满，丢弃请求：{lowest.request.mapid}")
+            lowest.future.set_result(False)
+        else:
+            heapq.heappush(self._pending, item)
+        self._pending_event.set()
+        self.request_count += 1
+        return future
+
+    def get_stats(self) -> dict:
+        """取统计信息，排队时间是从提交到发送出去的秒数"""
+        return {
+            "pending_count": self.pending_count,
+            "request_count": self.request_count,
+            "line_count": self.line_count,
+            "dropped_count": self.dropped_count,
+            "queue_wait": {
+                priority_class: {
+                    "count": stats["count"],
+                    "avg": stats["total"] / stats["count"],
+                    "max": stats["max"],
+                }
+                for priority_class, stats in self._wait_stats.items()
+            },
+        }
+
+    def _record_wait(self, item:PendingRequest, sent_time:float):
+        stats = self._wait_stats.get(item.priority_class, None)
+        if stats is None:
+            stats = self._wait_stats[item.priority_class] = {"count": 0, "total": 0.0, "max": 0.0}
+        wait_time = sent_time - item.enqueue_time
+        stats["count"] += 1
+        stats["total"] += wait_time
+        stats["max"] = max(stats["max"], wait_time)
+
+    async def _run(self):
+        while True:
+            while not self._pending:
+                self._pending_event.clear()
+                await self._pending_event.wait()
+
+            target, line, items = self._take_line()
+            try:
+                res = await self._irc_client.send_privmsg(target, line)
+            except asyncio.CancelledError:
+                for item in items:
+                    if not item.future.done():
+                        item.future.set_result(False)
+                raise
+            self.line_count += 1
+            sent_time = time.monotonic()
+            for item in items:
+                if res:
+                    self._record_wait(item, sent_time)
+                if not item.future.done():
+                    item.future.set_result(res)
+
+    def _take_line(self) -> tuple[str, str, list[PendingRequest]]:
+        """从排队的请求里取出优先级最高、能放进一行的请求，返回(target, 消息文本, 对应的排队项)"""
+        pending = sorted(self._pending)
+        target = pending[0].target
+        max_bytes = MAX_LINE_BYTES - LINE_PREFIX_MARGIN - len(f"PRIVMSG {target} :\r\n".encode())
+
+        # 同一个谱面的请求合并成一条，按优先级从高到低排列
+        entries: dict[str, BeatmapRequest] = {}
+        for item in pending:
+            if item.target != target:
+                continue
+            request = item.request
+            entry = entries.get(request.merge_key, None)
+            if entry is None:
+                entries[request.merge_key] = BeatmapRequest(list(request.user_names), request.mapid, request.info)
+            else:
+                entry.user_names += [name for name in request.user_names if name not in entry.user_names]
+
+        parts = []
+        used_keys = []
+        for key, entry in entries.items():
+            for style in ("compact", "minimal"):
+                part = entry.render(style)
+                if self._fits(self.SEPARATOR.join(parts + [part]), max_bytes):
+                    break
+            else:
+                break
+            parts.append(part)
+            used_keys.append(key)
+
+        if len(used_keys) <= 1:
+            entry = next(iter(entries.values()))
+            used_keys = [entry.merge_key]
+            line = self._render_single(entry, max_bytes)
+        else:
+            line = self.SEPARATOR.join(parts)
+
+        items = []
+        remaining = []
+        for item in pending:
+            if item.target == target and item.request.merge_key in used_keys:
+                items.append(item)
+            else:
+                remaining.append(item)
+        # 有序的列表本身就是堆
+        self._pending = remaining
+        return target, line, items
+
+    def _render_single(self, entry:BeatmapRequest, max_bytes:int) -> str:
+        """
+        只发一个谱面时使用能放得下的最完整的格式  
+        同一个谱面合并了太多人时最少的格式也放不下，这时候只写前几个名字，还放不下再去掉标题
+        """
+        for style in ("full", "compact", "minimal"):
+            line = entry.render(style)
+            if self._fits(line, max_bytes):
+                return line
+        for style in ("minimal", "link"):
+            for max_names in range(len(entry.user_names) - 1, -1, -1):
+                line = entry.render(style, max_names)
+                if self._fits(line, max_bytes):
+                    return line
+        # 没有名字的link格式只有谱面链接和人数，一定放得下
+        return line
+
+    @staticmethod
+    def _fits(line:str, max_bytes:int) -> bool:
+        return len(line.encode()) <= max_bytes
+
+async def send_beatmap_url(irc_client:AsyncIRCClient, mapid:MapId, user_name:str,
+                           price:float|None = None) -> tuple[dict|None, asyncio.Future]:
+    """
+    获取谱面信息并把点歌消息提交到点歌队列，不等待发送  
+    price是醒目留言的金额（元），普通弹幕为None，醒目留言会优先发送  
+    返回(谱面信息, future)，future的结果是是否发送成功，见BeatmapBatcher.submit。获取谱面信息失败时仍然会发送链接
+    """
+    beatmapinfo:dict|None = await get_beatmap_info(mapid.mapid_type, mapid.mapid_num, config.API_SERVER,
+                                                   mapid.sid, mapid.mode)
     if beatmapinfo:
         logger.info(f"谱面信息：{beatmapinfo}")
-        map_url:str = beatmapinfo["url"]
-        sid = beatmapinfo["sid"]
-        beatmap_msg = " ".join([f"【{user_name}】点歌：[{map_url} {beatmapinfo["artist"]} - {beatmapinfo["title"]}]",
-                                f"Sayo分流：[https://osu.sayobot.cn/home?search={sid} osu.sayobot.cn]",
-                                f"kitsu分流：[https://osu.direct/beatmapsets/{sid} osu.direct]",
-                                ])
-    else:
-        # 如果无法正常获取谱面信息则直接返回链接，不考虑正确性
-        beatmap_msg = f"【{user_name}】点歌：https://osu.ppy.sh/{mapid[0]}/{mapid[1:]}"
     logger.info("正在发送信息")
     
     target_name = config.USER_NAME if config.SEND_SELF else "BanchoBot"
-    await send_msg(irc_client, beatmap_msg, target_name)
-
-async def send_msg(irc_client:AsyncIRCClient, msg:str, target_name:str, is_action:bool=False):
-    # 给自己发送消息
-    if is_action:
-        msg = f"\x01ACTION {msg}\x01"
-    await irc_client.send_privmsg(target_name, msg)
\ No newline at end of file
+    sent_future = irc_client.beatmap_batcher.submit(target_name, BeatmapRequest([user_name], str(mapid), beatmapinfo),
+                                                    get_priority(price), "text" if price is None else "super_chat")
+    return beatmapinfo, sent_future
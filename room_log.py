@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import collections
+import concurrent.futures
+import gzip
+import logging
+import os
+import shutil
+import time
+from typing import *
+
+__all__ = (
+    'RoomLogWriter',
+)
+
+logger = logging.getLogger('osu-requests-bot.' + __name__)
+
+FLUSH_LINES = 64
+"""缓冲了多少行后立即写入"""
+FLUSH_INTERVAL = 1.0
+"""有缓冲的行时最多等多少秒写入"""
+MAX_OPEN_FILES = 16
+"""最多同时打开多少个文件，超过后关闭最久没写的，下次写时再用追加模式打开"""
+MAX_FILE_SIZE = 4 * 1024 * 1024
+"""文件超过这个大小（字节）后换一个新文件，写完的旧文件压缩成.gz，设为0则不分割"""
+
+
+class RoomLogWriter:
+    """
+    房间日志的后台写入器，所有房间共用
+
+    write只把行放进缓冲区，不会阻塞事件循环。缓冲够flush_lines行或者等了flush_interval秒后，在专用线程里批量写入文件。
+    所有文件操作都在同一个线程里按提交顺序执行，关闭文件前一定会先写完之前的行
+
+    文件在第一次写入时才创建，没有点歌的房间不会留下空文件。打开的文件数超过max_open_files时关闭最久没写的。
+    文件超过max_file_size后改名为 原文件名.序号.txt 并压缩成.gz，之后的行写到原文件名的新文件里
+
+    :param flush_lines: 缓冲了多少行后立即写入
+    :param flush_interval: 有缓冲的行时最多等多少秒写入
+    :param max_open_files: 最多同时打开多少个文件
+    :param max_file_size: 文件超过多少字节后分割，0表示不分割
+    """
+
+    def __init__(
+        self,
+        flush_lines: int = FLUSH_LINES,
+        flush_interval: float = FLUSH_INTERVAL,
+        max_open_files: int = MAX_OPEN_FILES,
+        max_file_size: int = MAX_FILE_SIZE,
+    ):
+        self._flush_lines = flush_lines
+        self._flush_interval = flush_interval
+        self._max_open_files = max_open_files
+        self._max_file_size = max_file_size
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='room-log')
+        self._files: collections.OrderedDict[str, TextIO] = collections.OrderedDict()
+        """路径 -> 文件，按最后写入时间排序，只在专用线程里访问"""
+        self._buffers: Dict[str, List[str]] = {}
+        """路径 -> 还没写入的行"""
+        self._buffered_count = 0
+        self._has_data_event = asyncio.Event()
+        self._full_event = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._closed = False
+
+        self.written_count = 0
+        """已经写入的行数"""
+        self.flush_count = 0
+        """批量写入的次数"""
+        self.open_count = 0
+        """打开文件的次数，包括被关闭后重新打开"""
+        self.rotate_count = 0
+        """分割文件的次数"""
+
+    def start(self):
+        if self._task is None and not self._closed:
+            self._task = asyncio.create_task(self._run())
+
+    def write(self, path: str, line: str):
+        """把一行放进缓冲区，line要包含换行符"""
+        if self._closed:
+            return
+        buffer = self._buffers.get(path, None)
+        if buffer is None:
+            buffer = self._buffers[path] = []
+        buffer.append(line)
+        self._buffered_count += 1
+        self._has_data_event.set()
+        if self._buffered_count >= self._flush_lines:
+            self._full_event.set()
+
+    def close_file(self, path: str):
+        """写完这个文件缓冲的行后关闭文件，不等待完成"""
+        if self._closed:
+            return
+        lines = self._buffers.pop(path, None)
+        if lines:
+            self._buffered_count -= len(lines)
+            self.written_count += len(lines)
+            self.flush_count += 1
+        self._executor.submit(self._close_file_sync, path, lines)
+
+    async def close(self):
+        """写完所有缓冲的行，关闭所有文件"""
+        if self._closed:
+            return
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+        self._closed = True
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._close_all_sync)
+        self._executor.shutdown(wait=False)
+
+    async def flush(self):
+        """把所有缓冲的行写入文件并等待写入完成"""
+        batches, self._buffers = self._buffers, {}
+        self._buffered_count = 0
+        self._has_data_event.clear()
+        self._full_event.clear()
+        if not batches:
+            return
+        self.written_count += sum(len(lines) for lines in batches.values())
+        self.flush_count += 1
+        # 已经从缓冲区取出来了，取消等待的协程时也要保证写入，否则这批行会丢失
+        await asyncio.shield(asyncio.get_running_loop().run_in_executor(self._executor, self._write_sync, batches))
+
+    def get_stats(self) -> dict:
+        return {
+            'buffered_count': self._buffered_count,
+            'written_count': self.written_count,
+            'flush_count': self.flush_count,
+            'open_file_count': len(self._files),
+            'open_count': self.open_count,
+            'rotate_count': self.rotate_count,
+        }
+
+    async def _run(self):
+        while True:
+            await self._has_data_event.wait()
+            # 有数据后最多再等flush_interval秒，期间攒够了行数就立即写
+            try:
+                await asyncio.wait_for(self._full_event.wait(), self._flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    def _open_sync(self, path: str) -> Optional[TextIO]:
+        file = self._files.get(path, None)
+        if file is not None:
+            self._files.move_to_end(path)
+            return file
+
+        while len(self._files) >= self._max_open_files:
+            _, old_file = self._files.popitem(last=False)
+            self._close_sync(old_file)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # 追加模式重新打开已有的文件时不会再写BOM
+            file = self._files[path] = open(path, 'a', encoding='utf-8-sig')
+        except OSError:
+            logger.exception('Failed to open room log, path=%s', path)
+            return None
+        self.open_count += 1
+        return file
+
+    def _write_sync(self, batches: Dict[str, List[str]]):
+        start_time = time.perf_counter()
+        for path, lines in batches.items():
+            file = self._open_sync(path)
+            if file is None:
+                continue
+            try:
+                file.write(''.join(lines))
+                file.flush()
+                if 0 < self._max_file_size <= os.fstat(file.fileno()).st_size:
+                    self._rotate_sync(path)
+            except OSError:
+                logger.exception('Failed to write room log, path=%s', path)
+        logger.debug(
+            'Wrote %d room log lines in %.1f ms',
+            sum(len(lines) for lines in batches.values()), (time.perf_counter() - start_time) * 1000
+        )
+
+    def _rotate_sync(self, path: str):
+        """关闭当前文件，改名后压缩，下次写入时创建新文件"""
+        self._close_sync(self._files.pop(path))
+        root, ext = os.path.splitext(path)
+        index = 1
+        while os.path.exists(f'{root}.{index}{ext}.gz') or os.path.exists(f'{root}.{index}{ext}'):
+            index += 1
+        segment_path = f'{root}.{index}{ext}'
+        os.replace(path, segment_path)
+        self.rotate_count += 1
+
+        try:
+            with open(segment_path, 'rb') as src, gzip.open(segment_path + '.gz.tmp', 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.replace(segment_path + '.gz.tmp', segment_path + '.gz')
+            os.remove(segment_path)
+        except OSError:
+            # 压缩失败时保留没压缩的文件
+            logger.exception('Failed to compress room log, path=%s', segment_path)
+
+    def _close_file_sync(self, path: str, lines: Optional[List[str]]):
+        if lines:
+            self._write_sync({path: lines})
+        file = self._files.pop(path, None)
+        if file is not None:
+            self._close_sync(file)
+
+    @staticmethod
+    def _close_sync(file: TextIO):
+        try:
+            file.close()
+        except OSError:
+            logger.exception('Failed to close room log, path=%s', file.name)
+
+    def _close_all_sync(self):
+        for path in list(self._files):
+            self._close_file_sync(path, None)
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+import collections
+import enum
+import json
+import logging
+import os
+import time
+from typing import *
+
+__all__ = (
+    'ServerStats',
+    'ServerStatsTable',
+    'BreakerState',
+    'CircuitBreaker',
+)
+
+logger = logging.getLogger('osu-requests-bot.' + __name__)
+
+MIN_SUCCESS_RATE = 0.05
+"""计算期望耗时时成功率的下限，避免除以0"""
+FAILED_LATENCY = 5.0
+"""还没有成功过的API计算期望耗时时使用的延迟（秒）"""
+
+
+class ServerStats:
+    """单个API的统计信息，延迟和成功率都是指数加权移动平均（EWMA）"""
+
+    def __init__(
+        self,
+        latency: Optional[float] = None,
+        success_rate: Optional[float] = None,
+        total_count: int = 0,
+        success_count: int = 0,
+        last_used_time: float = 0,
+    ):
+        self.latency = latency
+        """成功请求的平均延迟（秒），None表示还没有成功过"""
+        self.success_rate = success_rate
+        """平均成功率，None表示还没有数据"""
+        self.total_count = total_count
+        self.success_count = success_count
+        self.last_used_time = last_used_time
+        """最后一次请求的时间戳"""
+
+    def record(self, latency: float, success: bool, alpha: float):
+        """
+        记录一次请求
+
+        :param latency: 耗时（秒）
+        :param success: 是否获取到了谱面信息
+        :param alpha: EWMA的平滑系数，越大越看重最近的结果
+        """
+        success_value = 1.0 if success else 0.0
+        if self.success_rate is None:
+            self.success_rate = success_value
+        else:
+            self.success_rate += alpha * (success_value - self.success_rate)
+        # 失败的请求可能立即返回（连接被拒绝等），算进延迟会让一直失败的API排到最前面
+        if success:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += alpha * (latency - self.latency)
+        self.total_count += 1
+        if success:
+            self.success_count += 1
+        self.last_used_time = time.time()
+
+    @property
+    def expected_time(self) -> float:
+        """期望多久能成功获取到信息，没有数据时返回0，让新的API优先被尝试"""
+        if self.success_rate is None:
+            return 0.0
+        latency = self.latency if self.latency is not None else FAILED_LATENCY
+        return latency / max(self.success_rate, MIN_SUCCESS_RATE)
+
+    def to_dict(self) -> dict:
+        return {
+            'latency': self.latency,
+            'success_rate': self.success_rate,
+            'total_count': self.total_count,
+            'success_count': self.success_count,
+            'last_used_time': self.last_used_time,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(
+            latency=data.get('latency', None),
+            success_rate=data.get('success_rate', None),
+            total_count=data.get('total_count', 0),
+            success_count=data.get('success_count', 0),
+            last_used_time=data.get('last_used_time', 0),
+        )
+
+
+class ServerStatsTable:
+    """
+    所有API的统计信息，用来按期望耗时给API排序
+
+    :param path: 持久化用的JSON文件路径
+    :param alpha: EWMA的平滑系数
+    """
+
+    def __init__(self, path: str, alpha: float = 0.2):
+        self._path = path
+        self._alpha = alpha
+        self._stats: Dict[str, ServerStats] = {}
+
+    def get(self, server_name: str) -> ServerStats:
+        stats = self._stats.get(server_name, None)
+        if stats is None:
+            stats = self._stats[server_name] = ServerStats()
+        return stats
+
+    def record(self, server_name: str, latency: float, success: bool):
+        self.get(server_name).record(latency, success, self._alpha)
+
+    def sort(self, server_names: Iterable[str]) -> List[str]:
+        """按期望耗时从小到大排序，期望耗时相同时保持原来的顺序"""
+        return sorted(server_names, key=lambda server_name: self.get(server_name).expected_time)
+
+    def get_idle_servers(self, server_names: Iterable[str], idle_time: float) -> List[str]:
+        """取超过idle_time秒没有请求过的API"""
+        min_time = time.time() - idle_time
+        return [
+            server_name for server_name in server_names
+            if self.get(server_name).last_used_time < min_time
+        ]
+
+    def load(self):
+        """从文件加载统计信息，文件不存在或者格式错误时忽略"""
+        try:
+            with open(self._path, encoding='utf-8') as f:
+                data = json.load(f)
+            self._stats = {
+                server_name: ServerStats.from_dict(stats_dict)
+                for server_name, stats_dict in data.items()
+            }
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, AttributeError, TypeError):
+            logger.exception('Failed to load server stats, path=%s', self._path)
+
+    def save(self):
+        """保存统计信息到文件"""
+        try:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            tmp_path = self._path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.get_stats(), f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self._path)
+        except OSError:
+            logger.exception('Failed to save server stats, path=%s', self._path)
+
+    def get_stats(self) -> Dict[str, dict]:
+        """取所有API的统计信息"""
+        return {server_name: stats.to_dict() for server_name, stats in self._stats.items()}
+
+
+class BreakerState(enum.Enum):
+    CLOSED = 'closed'
+    """正常请求"""
+    OPEN = 'open'
+    """熔断中，直接跳过"""
+    HALF_OPEN = 'half_open'
+    """冷却结束，只放一个试探请求"""
+
+
+class CircuitBreaker:
+    """
+    单个API的熔断器
+
+    连续失败failure_threshold次后熔断，熔断期间直接跳过这个API。cooldown秒后进入半开状态，只放行一个试探请求，
+    成功则恢复，失败则重新熔断
+
+    :param name: API名称，用于日志
+    :param failure_threshold: 连续失败多少次后熔断
+    :param cooldown: 熔断后多少秒再试探
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 3, cooldown: float = 30):
+        self._name = name
+        self._failure_threshold = failure_threshold
+        self._cooldown = cooldown
+
+        self._state = BreakerState.CLOSED
+        self._failure_count = 0
+        """连续失败次数"""
+        self._open_time = 0.0
+        """熔断开始的时间"""
+        self._trial_in_flight = False
+        """半开状态下是否已经有试探请求"""
+
+        self.skip_count = 0
+        """因为熔断被跳过的请求数"""
+        self.transition_counts: collections.Counter[str] = collections.Counter()
+        """状态转换次数，key是'旧状态->新状态'"""
+
+    @property
+    def state(self) -> BreakerState:
+        return self._state
+
+    def allow_request(self) -> bool:
+        """
+        是否允许发送请求，允许时调用方必须在请求结束后调用record_success、record_failure或release之一
+        """
+        if self._state == BreakerState.OPEN:
+            if time.monotonic() - self._open_time < self._cooldown:
+                self.skip_count += 1
+                return False
+            self._set_state(BreakerState.HALF_OPEN)
+
+        if self._state == BreakerState.HALF_OPEN:
+            if self._trial_in_flight:
+                self.skip_count += 1
+                return False
+            self._trial_in_flight = True
+        return True
+
+    def record_success(self):
+        self._failure_count = 0
+        self._trial_in_flight = False
+        if self._state != BreakerState.CLOSED:
+            self._set_state(BreakerState.CLOSED)
+
+    def record_failure(self):
+        self._trial_in_flight = False
+        self._failure_count += 1
+        if (
+            self._state == BreakerState.HALF_OPEN
+            or (self._state == BreakerState.CLOSED and self._failure_count >= self._failure_threshold)
+        ):
+            self._open_time = time.monotonic()
+            self._set_state(BreakerState.OPEN)
+
+    def release(self):
+        """请求被取消，没有结果，半开状态下允许下一个试探请求"""
+        self._trial_in_flight = False
+
+    def _set_state(self, state: BreakerState):
+        old_state = self._state
+        self._state = state
+        self.transition_counts[f'{old_state.value}->{state.value}'] += 1
+        logger.warning(
+            'Circuit breaker of %s: %s -> %s, failure_count=%d',
+            self._name, old_state.value, state.value, self._failure_count
+        )
+
+    def get_stats(self) -> dict:
+        return {
+            'state': self._state.value,
+            'failure_count': self._failure_count,
+            'skip_count': self.skip_count,
+            'transition_counts': dict(self.transition_counts),
+        }
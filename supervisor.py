@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import collections
+import logging
+from typing import *
+
+__all__ = (
+    'TaskSupervisor',
+)
+
+logger = logging.getLogger('osu-requests-bot.' + __name__)
+
+
+class TaskSupervisor:
+    """
+    有并发上限的任务池
+
+    提交的协程先进入等待队列，最多同时运行max_concurrency个。队列满时拒绝新提交的协程。协程抛出的异常会被记录和计数，
+    不会丢失。关闭时在限定时间内等待已提交的任务完成，超时后取消剩下的
+
+    :param name: 名称，用于日志
+    :param max_concurrency: 最多同时运行多少个协程
+    :param max_pending: 等待队列最多放多少个协程
+    """
+
+    def __init__(self, name: str, max_concurrency: int = 4, max_pending: int = 100):
+        self._name = name
+        self._max_concurrency = max_concurrency
+        self._max_pending = max_pending
+
+        self._pending: collections.deque[Coroutine] = collections.deque()
+        self._pending_event = asyncio.Event()
+        self._workers: List[asyncio.Task] = []
+        self._idle_event = asyncio.Event()
+        """没有排队和运行中的协程时为set"""
+        self._idle_event.set()
+        self._closed = False
+
+        self.in_flight_count = 0
+        """正在运行的协程数"""
+        self.submitted_count = 0
+        self.rejected_count = 0
+        """因为队列满了或者已经关闭被拒绝的协程数"""
+        self.success_count = 0
+        self.failure_count = 0
+        """抛出异常的协程数"""
+        self.cancelled_count = 0
+        """关闭时被取消或者没来得及运行的协程数"""
+        self.exception_counts: collections.Counter[str] = collections.Counter()
+        """异常类型名 -> 次数"""
+
+    @property
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    def start(self):
+        if self._workers or self._closed:
+            return
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self._max_concurrency)]
+
+    def submit(self, coro: Coroutine) -> bool:
+        """
+        提交协程
+
+        :return: 是否被接受，被拒绝的协程会直接关闭
+        """
+        if self._closed or len(self._pending) >= self._max_pending:
+            self.rejected_count += 1
+            logger.warning(
+                '%s: rejected a task, closed=%s, pending=%d', self._name, self._closed, len(self._pending)
+            )
+            coro.close()
+            return False
+        self._pending.append(coro)
+        self.submitted_count += 1
+        self._idle_event.clear()
+        self._pending_event.set()
+        return True
+
+    async def shut_down(self, timeout: float = 10):
+        """
+        停止接受新的协程，最多等待timeout秒让已提交的协程完成，然后取消剩下的
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if not self._idle_event.is_set():
+            logger.info(
+                '%s: draining, pending=%d, in_flight=%d', self._name, len(self._pending), self.in_flight_count
+            )
+            try:
+                await asyncio.wait_for(self._idle_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(
+                    '%s: drain timed out, pending=%d, in_flight=%d',
+                    self._name, len(self._pending), self.in_flight_count
+                )
+
+        for worker in self._workers:
+            worker.cancel()
+        if self._workers:
+            await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        while self._pending:
+            self._pending.popleft().close()
+            self.cancelled_count += 1
+        logger.info('%s: shut down, stats=%s', self._name, self.get_stats())
+
+    def get_stats(self) -> dict:
+        return {
+            'pending_count': len(self._pending),
+            'in_flight_count': self.in_flight_count,
+            'submitted_count': self.submitted_count,
+            'rejected_count': self.rejected_count,
+            'success_count': self.success_count,
+            'failure_count': self.failure_count,
+            'cancelled_count': self.cancelled_count,
+            'exception_counts': dict(self.exception_counts),
+        }
+
+    async def _worker(self):
+        while True:
+            while not self._pending:
+                self._pending_event.clear()
+                await self._pending_event.wait()
+
+            coro = self._pending.popleft()
+            self.in_flight_count += 1
+            try:
+                await coro
+                self.success_count += 1
+            except asyncio.CancelledError:
+                self.cancelled_count += 1
+                raise
+            except Exception as e:  # noqa
+                self.failure_count += 1
+                self.exception_counts[type(e).__name__] += 1
+                logger.exception('%s: task failed', self._name)
+            finally:
+                self.in_flight_count -= 1
+                if self.in_flight_count == 0 and not self._pending:
+                    self._idle_event.set()
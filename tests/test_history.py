@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+import unittest
+
+import history
+
+
+class ExplainConnection:
+    """把查询换成EXPLAIN QUERY PLAN，记录用到的索引"""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self._conn = conn
+        self.plan = []
+
+    def execute(self, sql, params=()):
+        self.plan += [row[3] for row in self._conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+        return self._conn.execute(sql, params)
+
+
+class QueryPlanTest(unittest.TestCase):
+    """不指定直播间时按时间范围查询也要走索引，不扫描整个表"""
+
+    def setUp(self):
+        conn = sqlite3.connect(':memory:')
+        self.addCleanup(conn.close)
+        history._create_tables(conn)
+        self.conn = ExplainConnection(conn)
+
+    def test_recent_since(self):
+        history.query_requests(self.conn, since=0)
+        self.assertEqual(self.conn.plan, ['SEARCH request USING INDEX request_ts (ts>?)'])
+
+    def test_top_maps_since(self):
+        history.count_maps(self.conn, since=0)
+        self.assertIn('SEARCH request USING INDEX request_ts (ts>?)', self.conn.plan)
+
+    def test_top_maps_room_since(self):
+        history.count_maps(self.conn, room_id=1, since=0)
+        self.assertIn('SEARCH request USING INDEX request_room_ts (room_id=? AND ts>?)', self.conn.plan)
+
+
+if __name__ == '__main__':
+    unittest.main()
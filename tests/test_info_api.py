@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+import info_api
+from info_cache import InfoCache, InfoStore
+from server_stats import ServerStatsTable
+
+REQUEST_COUNT = 100
+
+
+class GetInfoSingleFlightTest(unittest.IsolatedAsyncioTestCase):
+    """同一个谱面的并发get_info只请求一次API，所有请求共享结果"""
+
+    async def asyncSetUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self._store = InfoStore(os.path.join(self._tmp_dir.name, 'beatmap_info.db'))
+        self.upstream_count = 0
+        self.result = None
+        self.exception = None
+
+        # 只保留一个测试用的API，不请求网络
+        for patcher in (
+            unittest.mock.patch.dict(info_api.GET_INFO_COMMON, {'osu_html': self._stub_server}, clear=True),
+            unittest.mock.patch.object(info_api, 'info_cache', InfoCache()),
+            unittest.mock.patch.object(info_api, 'info_store', self._store),
+            unittest.mock.patch.object(
+                info_api, 'server_stats', ServerStatsTable(os.path.join(self._tmp_dir.name, 'stats.json'))
+            ),
+            unittest.mock.patch.object(info_api, '_breakers', {}),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def asyncTearDown(self):
+        await self._store.close()
+        self._tmp_dir.cleanup()
+
+    async def _stub_server(self, mapid_type, mapid_num):
+        self.upstream_count += 1
+        # 让所有请求都在获取完成之前到达
+        await asyncio.sleep(0.05)
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+    async def _get_info_concurrently(self):
+        return await asyncio.gather(
+            *(info_api.get_info('b', 75, 'osu_html') for _ in range(REQUEST_COUNT)),
+            return_exceptions=True
+        )
+
+    async def test_success(self):
+        self.result = {
+            'server': 'osu_html',
+            'artist': 'artist',
+            'title': 'title',
+            'sid': 1,
+            'url': 'https://osu.ppy.sh/beatmapsets/1#osu/75',
+        }
+        results = await self._get_info_concurrently()
+        self.assertEqual(self.upstream_count, 1)
+        self.assertEqual(results, [self.result] * REQUEST_COUNT)
+
+    async def test_none(self):
+        results = await self._get_info_concurrently()
+        self.assertEqual(self.upstream_count, 1)
+        self.assertEqual(results, [None] * REQUEST_COUNT)
+
+    async def test_server_exception(self):
+        # API的异常在_call_server里记为失败，所有请求都得到None
+        self.exception = RuntimeError('server error')
+        results = await self._get_info_concurrently()
+        self.assertEqual(self.upstream_count, 1)
+        self.assertEqual(results, [None] * REQUEST_COUNT)
+
+    async def test_server_exception_not_cached(self):
+        # API出错只是暂时的，不能写负缓存
+        self.exception = asyncio.TimeoutError()
+        self.assertIsNone(await info_api.get_info('b', 75, 'osu_html'))
+        self.exception = None
+        self.result = {'server': 'osu_html', 'artist': 'a', 'title': 't', 'sid': 1, 'url': 'u'}
+        self.assertEqual(await info_api.get_info('b', 75, 'osu_html'), self.result)
+        self.assertEqual(self.upstream_count, 2)
+
+    async def test_no_such_map_cached(self):
+        # API回答了没有这个谱面时写负缓存
+        self.assertIsNone(await info_api.get_info('b', 75, 'osu_html'))
+        self.assertIsNone(await info_api.get_info('b', 75, 'osu_html'))
+        self.assertEqual(self.upstream_count, 1)
+
+    async def test_lookup_exception(self):
+        # 获取过程本身抛出的异常由所有请求共享
+        exception = RuntimeError('lookup error')
+
+        async def get_info_from_server(mapid_type, mapid_num, server_name):
+            self.upstream_count += 1
+            await asyncio.sleep(0.05)
+            raise exception
+
+        with unittest.mock.patch.object(info_api, '_get_info_from_server', get_info_from_server):
+            results = await self._get_info_concurrently()
+        self.assertEqual(self.upstream_count, 1)
+        self.assertEqual(len(results), REQUEST_COUNT)
+        for result in results:
+            self.assertIs(result, exception)
+
+    async def test_cancel_one_caller(self):
+        # 取消其中一个请求不会取消共享的获取
+        self.result = {'server': 'osu_html', 'artist': 'a', 'title': 't', 'sid': 1, 'url': 'u'}
+        tasks = [asyncio.create_task(info_api.get_info('b', 75, 'osu_html')) for _ in range(REQUEST_COUNT)]
+        await asyncio.sleep(0)
+        tasks[0].cancel()
+        results = await asyncio.gather(*tasks[1:])
+        self.assertEqual(self.upstream_count, 1)
+        self.assertEqual(results, [self.result] * (REQUEST_COUNT - 1))
+
+
+    async def test_link_sid_not_cached_for_bid(self):
+        # 链接里的sid是观众发的，拼出来的信息不能让之后单独点这个bid的请求拿到
+        self.result = {'server': 'osu_html', 'artist': 'a', 'title': 't', 'sid': 1, 'url': 'u'}
+        info = await info_api.get_info('b', 75, 'osu_html', sid=1, mode='osu')
+        self.assertEqual(info['url'], 'https://osu.ppy.sh/beatmapsets/1#osu/75')
+        self.assertEqual(self.upstream_count, 1)
+        self.assertIs(info_api.info_cache.get(('b', 75)), info_api.MISS)
+        self.assertIsNone(await self._store.get(('b', 75)))
+
+        self.result = {'server': 'osu_html', 'artist': 'a', 'title': 't', 'sid': 2, 'url': 'v'}
+        self.assertEqual(await info_api.get_info('b', 75, 'osu_html'), self.result)
+        self.assertEqual(self.upstream_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
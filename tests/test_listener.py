@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import types
+import unittest
+import unittest.mock
+
+import listener
+import osu_irc
+from info_api import MapId
+from supervisor import TaskSupervisor
+
+TEXT_REQUEST_COUNT = 40
+SEND_INTERVAL = 0.01
+"""模拟IRC限速，每行消息发送要花的秒数"""
+
+
+class FakeIRCClient:
+    def __init__(self):
+        self.lines = []
+        self.beatmap_batcher = osu_irc.BeatmapBatcher(self)
+
+    async def send_privmsg(self, target, line):
+        await asyncio.sleep(SEND_INTERVAL)
+        self.lines.append(line)
+        return True
+
+
+class RequestPriorityTest(unittest.IsolatedAsyncioTestCase):
+    """点歌请求处理只占用到提交进IRC点歌队列为止，排队发送时醒目留言能插到普通弹幕前面"""
+
+    async def asyncSetUp(self):
+        self.irc_client = FakeIRCClient()
+        self.irc_client.beatmap_batcher.start()
+        self.addCleanup(self.irc_client.beatmap_batcher.close)
+        self.supervisor = TaskSupervisor('test', listener.MAX_CONCURRENT_REQUESTS, listener.MAX_PENDING_REQUESTS)
+        self.supervisor.start()
+        self.history = unittest.mock.Mock()
+
+        for patcher in (
+            unittest.mock.patch.object(listener, '_irc_client', self.irc_client),
+            unittest.mock.patch.object(listener, '_request_supervisor', self.supervisor),
+            unittest.mock.patch.object(listener, '_request_history', self.history),
+            unittest.mock.patch.object(listener, '_pending_sends', set()),
+            unittest.mock.patch.object(osu_irc, 'get_beatmap_info', self._get_info),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def asyncTearDown(self):
+        await self.supervisor.shut_down(0)
+
+    @staticmethod
+    async def _get_info(mapid_type, mapid_num, server_name, sid=None, mode=None):
+        # 标题很长，一行只放得下一张图
+        return {
+            'server': 'stub',
+            'artist': 'artist',
+            'title': 'title' * 60,
+            'sid': mapid_num,
+            'url': f'https://osu.ppy.sh/beatmapsets/{mapid_num}#osu/{mapid_num}',
+        }
+
+    async def test_super_chat_sent_before_queued_text(self):
+        room = types.SimpleNamespace(room_id=1)
+        for i in range(TEXT_REQUEST_COUNT):
+            listener._submit_request(room, str(i), f'user{i}', MapId('b', i + 1))
+        listener._submit_request(room, 'sc', 'sc_user', MapId('b', 999), price=100)
+
+        while len(self.irc_client.lines) < TEXT_REQUEST_COUNT + 1:
+            await asyncio.sleep(SEND_INTERVAL)
+        super_chat_index = next(i for i, line in enumerate(self.irc_client.lines) if 'sc_user' in line)
+        self.assertLess(super_chat_index, 2)
+
+        # 发送结果出来后才记进点歌记录
+        await asyncio.sleep(0)
+        self.assertEqual(self.history.record.call_count, TEXT_REQUEST_COUNT + 1)
+        outcomes = {call.args[4] for call in self.history.record.call_args_list}
+        self.assertEqual(outcomes, {listener.OUTCOME_SENT})
+        self.assertEqual(len(listener._pending_sends), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import queue
+import subprocess
+import sys
+import textwrap
+import threading
+import unittest
+
+import main
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class BlockingHandler(logging.Handler):
+    """模拟被堵住的stdout，unblock之前一直卡在输出里"""
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+        self.blocked_event = threading.Event()
+        self.unblock_event = threading.Event()
+
+    def emit(self, record):
+        self.blocked_event.set()
+        self.unblock_event.wait()
+        self.records.append(record)
+
+
+class BoundedQueueListenerTest(unittest.TestCase):
+    def _make_record(self, msg):
+        return logging.makeLogRecord({'msg': msg})
+
+    def test_stop_outputs_remaining_records(self):
+        handler = BlockingHandler()
+        handler.unblock_event.set()
+        listener = main.BoundedQueueListener(queue.Queue(), handler)
+        listener.start()
+        for i in range(3):
+            listener.queue.put(self._make_record(f'm{i}'))
+        self.assertTrue(listener.stop(5))
+        self.assertEqual([record.msg for record in handler.records], ['m0', 'm1', 'm2'])
+
+    def test_stop_timeout(self):
+        handler = BlockingHandler()
+        listener = main.BoundedQueueListener(queue.Queue(), handler)
+        listener.start()
+        listener.queue.put(self._make_record('blocked'))
+        listener.queue.put(self._make_record('abandoned'))
+        self.assertTrue(handler.blocked_event.wait(5))
+        thread = listener._log_thread
+        self.assertFalse(listener.stop(0.1))
+        self.assertTrue(listener.abandoned)
+
+        # 输出恢复后也不再输出剩下的日志
+        handler.unblock_event.set()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual([record.msg for record in handler.records], ['blocked'])
+
+    def test_process_exits_when_output_blocked(self):
+        # 退出时logging.shutdown会等待卡住的handler的锁，进程要能退出
+        code = textwrap.dedent('''
+            import logging, queue, threading
+            import main
+
+            class BlockingHandler(logging.StreamHandler):
+                def emit(self, record):
+                    with self.lock:
+                        threading.Event().wait()
+
+            main.LOG_STOP_TIMEOUT = 0.1
+            main.log_queue_handler = main.DroppingQueueHandler(queue.Queue(100))
+            logging.getLogger().addHandler(main.log_queue_handler)
+            main.log_listener = main.BoundedQueueListener(main.log_queue_handler.queue, BlockingHandler())
+            main.log_listener.start()
+            logging.getLogger().warning('blocked')
+            main.stop_logging()
+        ''')
+        result = subprocess.run([sys.executable, '-c', code], cwd=REPO_PATH, timeout=30)
+        self.assertEqual(result.returncode, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
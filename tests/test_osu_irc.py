@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import socket
+import struct
+import unittest
+import unittest.mock
+
+import osu_irc
+
+
+class CloseAfterResetTest(unittest.IsolatedAsyncioTestCase):
+    """对方重置连接后客户端在等待重连，这时关闭客户端不能抛出异常，否则退出时后面的清理都不会执行"""
+
+    async def asyncSetUp(self):
+        self.server = await asyncio.start_server(self._handle_client, '127.0.0.1', 0)
+        self.addAsyncCleanup(self._close_server)
+        self.disconnected = asyncio.Event()
+
+    async def _close_server(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def _handle_client(self, reader, writer):
+        writer.write(b':irc.test 001 test :Welcome\r\n')
+        await writer.drain()
+        await asyncio.sleep(0.05)
+        # SO_LINGER为0时关闭会发送RST
+        writer.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        writer.transport.abort()
+
+    async def test_close_after_reset(self):
+        client = osu_irc.AsyncIRCClient('127.0.0.1', self.server.sockets[0].getsockname()[1], 'test')
+        on_disconnect = client._on_disconnect
+
+        async def _on_disconnect():
+            await on_disconnect()
+            self.disconnected.set()
+
+        with unittest.mock.patch.object(osu_irc, 'RECONNECT_BASE_DELAY', 60), \
+                unittest.mock.patch.object(client, '_on_disconnect', _on_disconnect):
+            connect_task = asyncio.create_task(client.connect())
+            await asyncio.wait_for(self.disconnected.wait(), 5)
+            await client.close()
+            connect_task.cancel()
+            await asyncio.gather(connect_task, return_exceptions=True)
+        self.assertFalse(client.get_stats()['connected'])
+
+
+class FakeIRCClient:
+    def __init__(self):
+        self.lines = []
+
+    async def send_privmsg(self, target, line):
+        self.lines.append(f'PRIVMSG {target} :{line}\r\n')
+        return True
+
+
+class BeatmapBatcherTest(unittest.IsolatedAsyncioTestCase):
+    """同一个谱面合并了很多人的请求时，每一行仍然不能超过IRC的长度限制"""
+
+    async def test_many_names_for_one_map(self):
+        irc_client = FakeIRCClient()
+        batcher = osu_irc.BeatmapBatcher(irc_client)
+        self.addCleanup(batcher.close)
+        info = {
+            'server': 'stub',
+            'artist': 'artist',
+            'title': 'title',
+            'sid': 1,
+            'url': 'https://osu.ppy.sh/beatmapsets/1#osu/75',
+        }
+        futures = [
+            batcher.submit('BanchoBot', osu_irc.BeatmapRequest([f'viewer_with_a_long_name_{i:02}'], 'b75', info))
+            for i in range(15)
+        ]
+        batcher.start()
+        self.assertEqual(await asyncio.gather(*futures), [True] * 15)
+
+        self.assertEqual(len(irc_client.lines), 1)
+        line = irc_client.lines[0]
+        self.assertLessEqual(len(line.encode()), osu_irc.MAX_LINE_BYTES - osu_irc.LINE_PREFIX_MARGIN)
+        self.assertIn('等15人', line)
+        self.assertIn(info['url'], line)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from server_stats import ServerStats
+
+
+class ServerStatsTest(unittest.TestCase):
+    def test_fast_failures_sort_after_healthy_server(self):
+        failing = ServerStats()
+        healthy = ServerStats()
+        for _ in range(10):
+            failing.record(0.001, False, 0.2)
+            healthy.record(0.1, True, 0.2)
+        self.assertAlmostEqual(healthy.expected_time, 0.1)
+        self.assertGreater(failing.expected_time, healthy.expected_time)
+
+    def test_failure_latency_not_averaged(self):
+        stats = ServerStats()
+        stats.record(0.5, True, 0.5)
+        stats.record(0.001, False, 0.5)
+        self.assertAlmostEqual(stats.latency, 0.5)
+        self.assertAlmostEqual(stats.success_rate, 0.5)
+        self.assertAlmostEqual(stats.expected_time, 1.0)
+
+    def test_no_data(self):
+        self.assertEqual(ServerStats().expected_time, 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()